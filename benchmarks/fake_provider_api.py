@@ -0,0 +1,156 @@
+# coding: utf-8
+from __future__ import unicode_literals
+import hashlib
+import json
+import math
+import os
+import random
+import sys
+import threading
+import time
+import urlparse
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import locallib
+
+
+class FakeProviderApi(object):
+    '''
+    Behavior of the stand-in oDesk API: search counts derived from the query parameters (same query, same count),
+    response latency drawn from a distribution, random errors (HTTP 500) and throttling (HTTP 429) at given rates,
+    plus throttling of requests over max_requests_per_second.
+
+    latency is (distribution, mean in seconds, spread in seconds), distribution is one of LATENCY_DISTRIBUTIONS.
+    '''
+    SEARCH_PROVIDERS_PATH = '/api/profiles/v2/search/providers.json'
+    LATENCY_DISTRIBUTIONS = ('constant', 'uniform', 'normal', 'exponential', 'lognormal')
+    MAX_COUNT = 100000
+
+    def __init__(self, latency=('constant', 0.0, 0.0), error_rate=0.0, throttle_rate=0.0, max_requests_per_second=None, seed=1):
+        if latency[0] not in self.LATENCY_DISTRIBUTIONS:
+            raise Exception('Unsupported latency distribution "%s".' % latency[0])
+        self.latency = latency
+        self.error_rate = error_rate
+        self.throttle_rate = throttle_rate
+        self.max_requests_per_second = max_requests_per_second
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        # requests in the current second
+        self.second = None
+        self.second_requests = 0
+        self.stats = {'requests': 0, 'ok': 0, 'errors': 0, 'throttled': 0, 'not_found': 0}
+
+    def get_count(self, query):
+        '''
+        Deterministic search count of query parameters (without the OAuth ones).
+        '''
+        key = json.dumps(sorted((k, sorted(v)) for k, v in query.iteritems() if not k.startswith('oauth_')))
+        return int(hashlib.md5(key).hexdigest()[:8], 16) % self.MAX_COUNT
+
+    def get_latency(self):
+        distribution, mean, spread = self.latency
+        if distribution == 'constant':
+            return mean
+        with self.lock:
+            if distribution == 'uniform':
+                return max(0.0, self.random.uniform(mean - spread, mean + spread))
+            if distribution == 'normal':
+                return max(0.0, self.random.gauss(mean, spread))
+            if distribution == 'exponential':
+                return self.random.expovariate(1.0 / mean) if mean else 0.0
+            # lognormal with the given mean and standard deviation
+            if not mean:
+                return 0.0
+            sigma2 = math.log(1 + (spread / mean) ** 2)
+            return self.random.lognormvariate(math.log(mean) - sigma2 / 2, sigma2 ** 0.5)
+
+    def respond(self, path, query):
+        '''
+        (HTTP status, headers, body) for GET request of path with parsed query string.
+        '''
+        time.sleep(self.get_latency())
+        with self.lock:
+            self.stats['requests'] += 1
+            now = int(time.time())
+            if now != self.second:
+                self.second, self.second_requests = now, 0
+            self.second_requests += 1
+            over_limit = self.max_requests_per_second and self.second_requests > self.max_requests_per_second
+            r = self.random.random()
+            if over_limit or r < self.throttle_rate:
+                self.stats['throttled'] += 1
+                return 429, {'Retry-After': '1', 'X-Odesk-Error-Code': '429', 'X-Odesk-Error-Message': 'Too many requests'}, ''
+            if r < self.throttle_rate + self.error_rate:
+                self.stats['errors'] += 1
+                return 500, {'X-Odesk-Error-Code': '500', 'X-Odesk-Error-Message': 'Internal error'}, ''
+            if path != self.SEARCH_PROVIDERS_PATH:
+                self.stats['not_found'] += 1
+                return 404, {'X-Odesk-Error-Code': '404', 'X-Odesk-Error-Message': 'Not found'}, ''
+            self.stats['ok'] += 1
+        total = self.get_count(query)
+        return 200, {}, json.dumps({'providers': [], 'paging': {'offset': 0, 'count': 0, 'total': total}})
+
+
+class FakeProviderApiRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = str('HTTP/1.1')
+
+    def do_GET(self):
+        url = urlparse.urlparse(self.path)
+        status, headers, body = self.server.api.respond(url.path, urlparse.parse_qs(url.query))
+        body = body.encode('utf8')
+        self.send_response(status)
+        headers['Content-Type'] = 'application/json'
+        headers['Content-Length'] = '%d' % len(body)
+        for name, value in headers.iteritems():
+            self.send_header(str(name), str(value))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class FakeProviderApiServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, api):
+        HTTPServer.__init__(self, address, FakeProviderApiRequestHandler)
+        self.api = api
+
+    def serve_in_thread(self):
+        '''
+        Serve in a daemon thread, e.g. from benchmarks; base URL of the API is returned.
+        '''
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return 'http://%s:%d' % self.server_address
+
+
+def get_api_from_arguments():
+    '''
+    FakeProviderApi configured by command line options:
+    --latency distribution:mean_ms:spread_ms (e.g. lognormal:200:150), --error-rate, --throttle-rate,
+    --max-requests-per-second, --seed.
+    '''
+    latency = (locallib.get_argument('--latency', 'constant:0:0') + '::').split(':')
+    return FakeProviderApi(
+        (latency[0], float(latency[1] or 0) / 1000, float(latency[2] or 0) / 1000),
+        float(locallib.get_argument('--error-rate', 0)),
+        float(locallib.get_argument('--throttle-rate', 0)),
+        float(locallib.get_argument('--max-requests-per-second', 0)) or None,
+        int(locallib.get_argument('--seed', 1)),
+    )
+
+
+if __name__ == '__main__':
+    api = get_api_from_arguments()
+    server = FakeProviderApiServer((locallib.get_argument('--host', '127.0.0.1'), int(locallib.get_argument('--port', 8765))), api)
+    print 'Fake provider API listening on http://%s:%d' % server.server_address
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    print 'REQUESTS: %(requests)d, OK: %(ok)d, ERRORS: %(errors)d, THROTTLED: %(throttled)d, NOT FOUND: %(not_found)d' % api.stats
@@ -0,0 +1,198 @@
+# coding: utf-8
+from __future__ import unicode_literals
+import imp
+import io
+import os
+import random
+import sys
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT_DIR)
+import locallib
+
+
+def load_script(name):
+    '''
+    Import one of the hyphenated scripts (e.g. create-city-db.py) as a module.
+    '''
+    return imp.load_source(name.replace('-', '_'), os.path.join(ROOT_DIR, name + '.py'))
+
+
+class SyntheticDataGenerator(object):
+    '''
+    Synthetic inputs at configurable scale, in the formats of the real ones:
+     * cities.txt: GeoNames dump (like cities1000.txt), rows of countries not supported by create-city-db.py included
+     * city_list.csv: dirty custom city list (lowercased/concatenated/misspelled names, duplicates, unknown cities)
+     * skill_list.csv and patternsCities2.txt: the two skill lists
+
+    With distribution 'dense' cities are clustered around metro areas (many pairs within the distance radius),
+    with 'sparse' they are spread uniformly over the country. Output only depends on the arguments and seed.
+    '''
+    COUNTRIES = {
+        # name, (min latitude, max latitude, min longitude, max longitude), admin1 codes
+        'US': ('United States', (25.0, 49.0, -124.0, -67.0), None),
+        'CA': ('Canada', (42.0, 60.0, -130.0, -60.0), None),
+        'AU': ('Australia', (-38.0, -12.0, 115.0, 153.0), ['01', '02', '03', '04', '05', '06', '07', '08']),
+        'GB': ('United Kingdom', (50.0, 58.0, -6.0, 1.7), ['ENG', 'SCT', 'WLS', 'NIR']),
+    }
+    # rows of these countries are written to the GeoNames dump only
+    OTHER_COUNTRIES = {
+        'FR': (43.0, 50.0, -1.0, 7.0),
+        'DE': (47.5, 54.5, 6.0, 15.0),
+        'BR': (-30.0, -3.0, -60.0, -35.0),
+        'IN': (8.0, 30.0, 70.0, 88.0),
+    }
+    OTHER_COUNTRIES_RATE = 0.4
+    SYLLABLES = [
+        'new', 'york', 'los', 'an', 'ge', 'les', 'ro', 'ck', 'ing', 'ham', 'ber', 'lin', 'pa', 'ris', 'to', 'ron',
+        'mon', 'real', 'sp', 'ring', 'field', 'dal', 'las', 'hou', 'ston', 'bos', 'port', 'land', 'wood', 'ville',
+        'mel', 'bour', 'ne', 'syd', 'ney', 'man', 'ches', 'ter', 'glas', 'gow',
+    ]
+    SUFFIXES = ['Falls', 'Heights', 'Springs', 'North', 'South', 'Park', 'Beach', 'City']
+    SKILL_WORDS = [
+        'php', 'python', 'java', 'ios', 'android', 'wordpress', 'seo', 'design', 'logo', 'data', 'entry',
+        'excel', 'ruby', 'rails', 'django', 'sql', 'writing', 'translation', 'video', 'marketing',
+    ]
+    # cities per metro area in dense distribution and their spread (degrees)
+    CITIES_PER_METRO = 200
+    METRO_SPREAD = 0.4
+
+    @classmethod
+    def generate(self, path, cities, custom_cities, skills, distribution='dense', seed=1):
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        rnd = random.Random(seed)
+        sample = self.write_official_data(rnd, os.path.join(path, 'cities.txt'), cities, custom_cities, distribution)
+        self.write_custom_data(rnd, os.path.join(path, 'city_list.csv'), sample, custom_cities)
+        self.write_skill_data(rnd, os.path.join(path, 'skill_list.csv'), os.path.join(path, 'patternsCities2.txt'), skills)
+
+    @classmethod
+    def get_regions(self):
+        '''
+        {country_code: [(admin1_code, custom region name or None), ...]}
+        '''
+        city_manager = load_script('create-city-db').CityManager
+        regions = {}
+        for country_code, (_, _, admin1_codes) in self.COUNTRIES.iteritems():
+            regions[country_code] = [(admin1_code, None) for admin1_code in admin1_codes or []]
+        for key, admin1_code in sorted(city_manager.CUSTOM_REGION_NAME_TO_ADMIN1_CODE.iteritems()):
+            country_code, custom_region = key.split('.', 1)
+            regions[country_code].append((admin1_code.split('.', 1)[1], custom_region))
+        return regions
+
+    @classmethod
+    def get_name(self, rnd):
+        name = ''.join(rnd.choice(self.SYLLABLES) for _ in range(rnd.randint(1, 3))).title()
+        if rnd.random() < 0.2:
+            name = '%s %s' % (name, rnd.choice(self.SUFFIXES))
+        return name
+
+    @classmethod
+    def get_coordinates(self, rnd, bbox, metros):
+        min_latitude, max_latitude, min_longitude, max_longitude = bbox
+        if metros:
+            latitude, longitude = rnd.choice(metros)
+            latitude = min(max(rnd.gauss(latitude, self.METRO_SPREAD), min_latitude), max_latitude)
+            longitude = min(max(rnd.gauss(longitude, self.METRO_SPREAD), min_longitude), max_longitude)
+            return latitude, longitude
+        return rnd.uniform(min_latitude, max_latitude), rnd.uniform(min_longitude, max_longitude)
+
+    @classmethod
+    def write_official_data(self, rnd, path, cities, custom_cities, distribution):
+        '''
+        Write GeoNames dump of cities rows, return a random sample (reservoir) of custom_cities
+        (country_code, name, admin1_code, custom region) of the supported countries.
+        '''
+        regions = self.get_regions()
+        country_codes = sorted(self.COUNTRIES)
+        other_country_codes = sorted(self.OTHER_COUNTRIES)
+        bboxes = dict([(cc, country[1]) for cc, country in self.COUNTRIES.iteritems()] + self.OTHER_COUNTRIES.items())
+        metros = {}
+        if distribution == 'dense':
+            for cc in sorted(bboxes):
+                metro_count = max(1, cities // self.CITIES_PER_METRO // len(bboxes))
+                metros[cc] = [self.get_coordinates(rnd, bboxes[cc], None) for _ in range(metro_count)]
+        sample = []
+        seen = 0
+        with io.open(path, 'w', encoding='utf8') as f:
+            for i in xrange(cities):
+                if rnd.random() < self.OTHER_COUNTRIES_RATE:
+                    cc = rnd.choice(other_country_codes)
+                    admin1_code, custom_region = '%02d' % rnd.randint(1, 20), None
+                else:
+                    cc = rnd.choice(country_codes)
+                    admin1_code, custom_region = rnd.choice(regions[cc])
+                name = self.get_name(rnd)
+                latitude, longitude = self.get_coordinates(rnd, bboxes[cc], metros.get(cc))
+                alternatenames = ','.join([name.lower(), '%s é' % name])
+                population = int(rnd.paretovariate(1.2) * 1000)
+                f.write('\t'.join([
+                    '%d' % (1000000 + i), name, name, alternatenames, '%.5f' % latitude, '%.5f' % longitude,
+                    'P', 'PPL', cc, '', admin1_code, '', '', '', '%d' % population, '', '0', 'UTC', '2013-01-01',
+                ]) + '\n')
+                if cc in self.COUNTRIES:
+                    seen += 1
+                    if len(sample) < custom_cities:
+                        sample.append((cc, name, admin1_code, custom_region))
+                    else:
+                        j = rnd.randint(0, seen - 1)
+                        if j < custom_cities:
+                            sample[j] = (cc, name, admin1_code, custom_region)
+        return sample
+
+    @classmethod
+    def get_dirty_name(self, rnd, name):
+        name = name.lower()
+        if rnd.random() < 0.3:
+            name = name.replace(' ', '')
+        if rnd.random() < 0.1 and len(name) > 4:
+            name = name[:-1]
+        if rnd.random() < 0.05 and len(name) > 4:
+            i = rnd.randint(0, len(name) - 2)
+            name = name[:i] + name[i + 1] + name[i] + name[i + 2:]
+        return name
+
+    @classmethod
+    def write_custom_data(self, rnd, path, sample, custom_cities):
+        rows = []
+        for i in xrange(custom_cities):
+            if rows and rnd.random() < 0.1:
+                # duplicate
+                rows.append(rnd.choice(rows))
+                continue
+            cc, name, admin1_code, custom_region = rnd.choice(sample)
+            if rnd.random() < 0.05:
+                # unknown city
+                name = '%s %s' % (self.get_name(rnd), self.get_name(rnd))
+            r = rnd.random()
+            region = custom_region if custom_region and r < 0.6 else ('-' if r < 0.7 else '')
+            rows.append('%s,%s,%s,%d' % (self.COUNTRIES[cc][0], self.get_dirty_name(rnd, name), region, rnd.randint(1, 500)))
+        with io.open(path, 'w', encoding='utf8') as f:
+            for row in rows:
+                f.write(row + '\n')
+
+    @classmethod
+    def write_skill_data(self, rnd, skill1_path, skill2_path, skills):
+        names = set()
+        while len(names) < skills:
+            names.add(' '.join(rnd.choice(self.SKILL_WORDS) for _ in range(rnd.randint(1, 3))))
+        names = sorted(names)
+        # both lists share about half of the skills, like the real ones
+        split = len(names) // 2
+        with io.open(skill1_path, 'w', encoding='utf8') as f:
+            for name in names[:split + split // 2]:
+                f.write('%s,%d\n' % (name.replace(' ', '-'), rnd.randint(1, 3000)))
+        with io.open(skill2_path, 'w', encoding='utf8') as f:
+            for name in names[split // 2:]:
+                f.write('%d\t%d\t%d\t%s\n' % (rnd.randint(1, 30), 1, rnd.randint(1, 10), name))
+
+
+if __name__ == '__main__':
+    SyntheticDataGenerator.generate(
+        locallib.get_argument('--path', os.path.join(ROOT_DIR, 'benchmarks', 'data', 'synthetic')),
+        int(locallib.get_argument('--cities', 10000)),
+        int(locallib.get_argument('--custom-cities', 2000)),
+        int(locallib.get_argument('--skills', 20)),
+        locallib.get_argument('--distribution', 'dense'),
+        int(locallib.get_argument('--seed', 1)),
+    )
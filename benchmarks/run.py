@@ -0,0 +1,171 @@
+# coding: utf-8
+from __future__ import unicode_literals
+import hashlib
+import json
+import os
+import sys
+import time
+
+from fake_provider_api import FakeProviderApiServer, get_api_from_arguments
+from generate import ROOT_DIR, SyntheticDataGenerator, load_script
+import locallib
+
+BENCHMARKS_DIR = os.path.join(ROOT_DIR, 'benchmarks')
+BASELINE_PATH = os.path.join(BENCHMARKS_DIR, 'baseline.json')
+
+
+class FakeProviderApiClient(object):
+    '''
+    Stands in for odesk.Client: search counts derived from the query, no network.
+    '''
+    def __init__(self):
+        self.provider_v2 = self
+
+    def get(self, url, data=None):
+        return {'paging': {'total': int(hashlib.md5(json.dumps(data, sort_keys=True)).hexdigest()[:4], 16)}}
+
+
+class BenchmarkRunner(object):
+    '''
+    Times CityManager.get_cities, CityDistanceManager.process and CityDataManager.process on a synthetic
+    dataset (see SyntheticDataGenerator) and compares times and output digests against the stored baseline.
+    '''
+    SCALES = {
+        # cities in GeoNames dump, custom cities, skills, max API calls
+        'small': (10000, 2000, 20, 2000),
+        'medium': (300000, 20000, 50, 20000),
+        'large': (3000000, 100000, 100, 100000),
+    }
+    # slowdowns smaller than this are timer noise, not regressions
+    MIN_SLOWDOWN_SECONDS = 0.1
+
+    @classmethod
+    def run(self, scale, distribution='dense', workers=1, concurrency=1, seed=1, fake_api=None, requests_per_second=None):
+        '''
+        {benchmark name: {'seconds': ..., 'rows': ..., 'digest': md5 of the output}}
+
+        With fake_api (FakeProviderApi) the skills stage uses the real API client stack (ApiClientFactory,
+        RateLimitedApiClient when requests_per_second is set) against fake_api served over local HTTP,
+        otherwise FakeProviderApiClient.
+        '''
+        cities, custom_cities, skills, max_api_calls = self.SCALES[scale]
+        path = os.path.join(BENCHMARKS_DIR, 'data', '%s-%s-%d' % (scale, distribution, seed))
+        if not os.path.exists(os.path.join(path, 'city_list.csv')):
+            print 'Generating %s dataset in %s' % (scale, path)
+            SyntheticDataGenerator.generate(path, cities, custom_cities, skills, distribution, seed)
+        city_manager = load_script('create-city-db').CityManager
+        city_distance_manager = load_script('create-city-distance-db').CityDistanceManager
+        skills_module = load_script('create-city-skills-users-db')
+        skills_module.DEBUG = 0
+        city_db = os.path.join(path, 'OUTPUT_city_list.csv')
+        city_distances_db = os.path.join(path, 'OUTPUT_city_distance.csv')
+        result_db = os.path.join(path, 'OUTPUT_city_skill_contractor_count.csv')
+
+        results = {}
+        official_data = self.measure(results, 'load_official_data', lambda: city_manager.load_official_data(os.path.join(path, 'cities.txt')))
+        custom_data = city_manager.load_custom_data(os.path.join(path, 'city_list.csv'))
+        cities = self.measure(results, 'get_cities', lambda: city_manager.get_cities(custom_data, official_data))
+        rows = city_manager.get_csv_rows(cities)
+        city_manager.write_csv(rows, city_db)
+        results['get_cities']['rows'] = len(custom_data)
+        results['get_cities']['digest'] = self.get_file_digest(city_db)
+
+        self.measure(results, 'distance_process', lambda: city_distance_manager.process(city_db, city_distances_db, workers))
+        results['distance_process']['rows'] = len(rows)
+        results['distance_process']['digest'] = self.get_file_digest(city_distances_db)
+
+        if fake_api:
+            base_url = FakeProviderApiServer(('127.0.0.1', 0), fake_api).serve_in_thread()
+            api_client = skills_module.ApiClientFactory.get_odesk_client('public_key', 'secret_key', pool_size=concurrency, base_url=base_url)
+            if requests_per_second:
+                api_client = skills_module.RateLimitedApiClient(api_client, skills_module.TokenBucket(requests_per_second, requests_per_second), concurrency)
+        else:
+            api_client = FakeProviderApiClient()
+        self.measure(results, 'skills_process', lambda: skills_module.CityDataManager.process(
+            api_client,
+            max_api_calls,
+            city_db,
+            city_distances_db,
+            os.path.join(path, 'skill_list.csv'),
+            os.path.join(path, 'patternsCities2.txt'),
+            result_db,
+            concurrency=concurrency,
+        ))
+        with open(result_db, 'rb') as f:
+            results['skills_process']['rows'] = sum(1 for _ in f)
+        results['skills_process']['digest'] = self.get_file_digest(result_db)
+        # counts of the fake API differ from FakeProviderApiClient ones, so its results have own baseline
+        return '%s-%s-%d%s' % (scale, distribution, seed, '-fake-api' if fake_api else ''), results
+
+    @classmethod
+    def measure(self, results, name, function):
+        start = time.time()
+        value = function()
+        results[name] = {'seconds': time.time() - start, 'rows': len(value) if hasattr(value, '__len__') else None}
+        return value
+
+    @classmethod
+    def get_file_digest(self, path):
+        with open(path, 'rb') as f:
+            # line endings of csv.writer are not relevant
+            return hashlib.md5(f.read().replace(b'\r\n', b'\n')).hexdigest()
+
+    @classmethod
+    def compare(self, name, results, baseline, tolerance):
+        '''
+        Print results next to baseline, return False if any output differs or time exceeds baseline * tolerance
+        (by more than MIN_SLOWDOWN_SECONDS).
+        '''
+        ok = True
+        print
+        print 'BENCHMARK %s' % name
+        for benchmark in sorted(results):
+            result = results[benchmark]
+            expected = baseline.get(benchmark)
+            line = '%-20s %10.3fs' % (benchmark, result['seconds'])
+            if result['rows']:
+                line += ' %12.0f rows/s' % (result['rows'] / max(result['seconds'], 1e-9))
+            if expected:
+                ratio = result['seconds'] / max(expected['seconds'], 1e-9)
+                line += '   baseline %10.3fs  x%.2f' % (expected['seconds'], ratio)
+                if ratio > tolerance and result['seconds'] - expected['seconds'] > self.MIN_SLOWDOWN_SECONDS:
+                    line += '  SLOWER'
+                    ok = False
+                if expected.get('digest') and expected['digest'] != result.get('digest', expected['digest']):
+                    line += '  OUTPUT CHANGED'
+                    ok = False
+            else:
+                line += '   no baseline'
+            print line
+        return ok
+
+    @classmethod
+    def load_baseline(self):
+        if not os.path.exists(BASELINE_PATH):
+            return {}
+        with open(BASELINE_PATH, 'rb') as f:
+            return json.load(f)
+
+    @classmethod
+    def save_baseline(self, name, results):
+        baseline = self.load_baseline()
+        baseline[name] = results
+        with open(BASELINE_PATH, 'wb') as f:
+            json.dump(baseline, f, indent=2, sort_keys=True)
+        print 'Baseline %s saved to %s' % (name, BASELINE_PATH)
+
+
+if __name__ == '__main__':
+    name, results = BenchmarkRunner.run(
+        locallib.get_argument('--scale', 'small'),
+        locallib.get_argument('--distribution', 'dense'),
+        int(locallib.get_argument('--workers', 1)),
+        int(locallib.get_argument('--concurrency', 1)),
+        int(locallib.get_argument('--seed', 1)),
+        get_api_from_arguments() if '--fake-api' in sys.argv else None,
+        float(locallib.get_argument('--requests-per-second', 0)) or None,
+    )
+    if '--save-baseline' in sys.argv:
+        BenchmarkRunner.save_baseline(name, results)
+    elif not BenchmarkRunner.compare(name, results, BenchmarkRunner.load_baseline().get(name, {}), float(locallib.get_argument('--tolerance', 1.25))):
+        sys.exit(1)
@@ -1,7 +1,15 @@
 # coding: utf-8
 from __future__ import unicode_literals
+import bisect
 import csv
+import gzip
+import marshal
+import os
+import sys
+import time
+import zipfile
 from collections import defaultdict
+from contextlib import closing, contextmanager
 import locallib
 
 
@@ -23,11 +31,39 @@ class CustomCityListImporter(csv.DictReader):
 
 class GeonamesAdmin1CodesImporter(csv.DictReader):
     DELIMITER = str('\t')
+    QUOTECHAR = str('|') # char " is used in field values
     fieldnames = [
             'admin1_code',
             'name',
             'asciiname',
-            'inhabitant_count',
+            'geonameid',
+    ]
+
+
+
+class GeonamesCountryInfoImporter(csv.DictReader):
+    DELIMITER = str('\t')
+    QUOTECHAR = str('|') # char " is used in field values
+    fieldnames = [
+        'iso',
+        'iso3',
+        'iso_numeric',
+        'fips',
+        'country',
+        'capital',
+        'area',
+        'population',
+        'continent',
+        'tld',
+        'currency_code',
+        'currency_name',
+        'phone',
+        'postal_code_format',
+        'postal_code_regex',
+        'languages',
+        'geonameid',
+        'neighbours',
+        'equivalent_fips_code',
     ]
 
 
@@ -59,7 +95,248 @@ class GeonamesCityListImporter(csv.DictReader):
 
 
 
+class GeonamesCity(object):
+    '''
+    Compact official city record holding only the GeoNames fields used by the scripts.
+    Supports row['field'] access like the decoded dict rows.
+    '''
+    __slots__ = (
+        'geonameid',
+        'name',
+        'asciiname',
+        'latitude',
+        'longitude',
+        'country_code',
+        'admin1_code',
+        'population',
+    )
+    # positions of __slots__ fields in GeonamesCityListImporter rows
+    COLUMNS = tuple(GeonamesCityListImporter.fieldnames.index(f) for f in __slots__)
+
+    def __init__(self, *values):
+        for field, value in zip(self.__slots__, values):
+            setattr(self, field, value)
+
+    def __getitem__(self, field):
+        return getattr(self, field)
+
+    def __repr__(self):
+        return 'GeonamesCity(%s)' % ', '.join(repr(getattr(self, f)) for f in self.__slots__)
+
+    @classmethod
+    def from_raw_row(self, raw_row, encoding='utf8'):
+        return self(*[raw_row[i].decode(encoding) for i in self.COLUMNS])
+
+
+
+class OfficialCityIndex(object):
+    '''
+    Hash index over official data, built once.
+
+    Rows are keyed by (country_code, lowercased name) and (country_code, lowercased asciiname),
+    with an additional (country_code, lowercased name, admin1_code) table for region refinement.
+    Tables hold positions in official_data, in official data order, so results are the same
+    as scanning the whole list.
+    '''
+    def __init__(self, official_data, tables=None):
+        self.official_data = official_data
+        if tables is not None:
+            self.by_name, self.by_name_and_admin1 = tables
+            return
+        self.by_name = defaultdict(list)
+        self.by_name_and_admin1 = defaultdict(list)
+        for position, offical_row in enumerate(official_data):
+            for name in set([offical_row['name'].lower(), offical_row['asciiname'].lower()]):
+                self.by_name[(offical_row['country_code'], name)].append(position)
+                self.by_name_and_admin1[(offical_row['country_code'], name, offical_row['admin1_code'])].append(position)
+
+    def get_tables(self):
+        '''
+        Index tables as plain dicts, restored by passing them back as OfficialCityIndex(official_data, tables).
+        '''
+        return dict(self.by_name), dict(self.by_name_and_admin1)
+
+    def lookup(self, city_manager, custom_data_row, skip_region=False):
+        '''
+        Same semantics as CityManager.row_match (without prefix matching) applied to all official rows.
+        '''
+        custom_data_row = city_manager.force_match(custom_data_row)
+        country_code = city_manager.custom_country_name_to_ISO_3166_2_code(custom_data_row['country'])
+        city = custom_data_row['city'].lower()
+        if (country_code, city) not in self.by_name:
+            return []
+        if custom_data_row['region'] not in ('', '-') and not skip_region:
+            admin1_code = city_manager.get_admin1_code(custom_data_row['country'], custom_data_row['region'])
+            return [self.official_data[p] for p in self.by_name_and_admin1.get((country_code, city, admin1_code), [])]
+        return [self.official_data[p] for p in self.by_name[(country_code, city)]]
+
+
+
+class GeonamesRegionTables(object):
+    '''
+    Country and admin1 (first-level region) lookup tables built once from GeoNames countryInfo.txt
+    and admin1CodesASCII.txt. Countries are keyed by ISO code and lowercased name, admin1 codes by
+    (country_code, lowercased name, asciiname or admin1 code); every lookup is a single dict access.
+    '''
+    def __init__(self, countries, admin1_codes):
+        # {country_code: name}
+        self.country_names = {}
+        # {lowercased name or country_code: country_code}
+        self.country_codes = {}
+        for country_code, name in countries:
+            self.country_names[country_code] = name
+            self.country_codes[name.lower()] = country_code
+            self.country_codes[country_code.lower()] = country_code
+        # {'US.CA': 'California', ...}
+        self.admin1_names = {}
+        # {(country_code, lowercased name, asciiname or admin1 code): 'US.CA', ...}
+        self.admin1_codes = {}
+        for code, name, asciiname in admin1_codes:
+            country_code, admin1_code = code.split('.', 1)
+            self.admin1_names[code] = name
+            for key in (admin1_code.lower(), name.lower(), asciiname.lower()):
+                self.admin1_codes.setdefault((country_code, key), code)
+
+    @classmethod
+    def load(self, admin1_codes_path, country_info_path):
+        with open(country_info_path, 'rb') as csv_file:
+            # header and notes are comment lines
+            reader = GeonamesCountryInfoImporter(
+                (line for line in csv_file if not line.startswith(b'#')),
+                delimiter=GeonamesCountryInfoImporter.DELIMITER,
+                quotechar=GeonamesCountryInfoImporter.QUOTECHAR,
+            )
+            countries = [(row['iso'].decode('utf8'), row['country'].decode('utf8')) for row in reader]
+        with open(admin1_codes_path, 'rb') as csv_file:
+            reader = GeonamesAdmin1CodesImporter(csv_file, delimiter=GeonamesAdmin1CodesImporter.DELIMITER, quotechar=GeonamesAdmin1CodesImporter.QUOTECHAR)
+            admin1_codes = [(row['admin1_code'].decode('utf8'), row['name'].decode('utf8'), row['asciiname'].decode('utf8')) for row in reader]
+        return self(countries, admin1_codes)
+
+
+
+class CityNameCandidateIndex(object):
+    '''
+    Candidate retrieval for custom city names without a direct match.
+
+    Names come from official name, asciiname and alternatenames, normalized by normalize_name;
+    alternatenames ({geonameid: comma separated names}) aren't kept in official rows, so they are passed separately.
+    Per country there is a sorted array of names for prefix lookups (bisect) and n-gram posting
+    lists bucketed by name length for fuzzy lookups; fuzzy candidates are ranked by edit distance.
+    '''
+    NGRAM_SIZE = 3
+
+    def __init__(self, official_data, tables=None, alternatenames=None):
+        self.official_data = official_data
+        if tables is not None:
+            self.sorted_names, self.name_positions, self.ngram_names = tables
+            return
+        alternatenames = alternatenames or {}
+        name_positions = defaultdict(set)
+        for position, offical_row in enumerate(official_data):
+            for name in self.get_row_names(offical_row, alternatenames.get(offical_row['geonameid'], '')):
+                name_positions[(offical_row['country_code'], name)].add(position)
+
+        # country_code => sorted [name, ...]
+        self.sorted_names = defaultdict(list)
+        # (country_code, name) => (official_data position, ...)
+        self.name_positions = {}
+        # (country_code, ngram, len(name)) => [name, ...]
+        self.ngram_names = defaultdict(list)
+        for (country_code, name), positions in sorted(name_positions.iteritems()):
+            self.sorted_names[country_code].append(name)
+            self.name_positions[(country_code, name)] = tuple(sorted(positions))
+            for ngram in set(self.get_ngrams(name)):
+                self.ngram_names[(country_code, ngram, len(name))].append(name)
+
+    def get_tables(self):
+        '''
+        Index tables as plain dicts, restored by passing them back as CityNameCandidateIndex(official_data, tables).
+        '''
+        return dict(self.sorted_names), self.name_positions, dict(self.ngram_names)
+
+    @classmethod
+    def normalize_name(self, name):
+        '''
+        Lowercase name with everything but letters and digits removed ("New York" => "newyork").
+        '''
+        return ''.join(c for c in name.lower() if c.isalnum())
+
+    @classmethod
+    def get_row_names(self, offical_row, alternatenames=''):
+        names = set([offical_row['name'], offical_row['asciiname']])
+        names.update(alternatenames.split(','))
+        return set(self.normalize_name(n) for n in names) - set([''])
+
+    @classmethod
+    def get_ngrams(self, name):
+        padded = '^%s$' % name
+        return [padded[i:i + self.NGRAM_SIZE] for i in range(max(1, len(padded) - self.NGRAM_SIZE + 1))]
+
+    @classmethod
+    def get_edit_distance(self, a, b, max_distance):
+        '''
+        Levenshtein distance of a and b, or max_distance + 1 once it is known to be larger than max_distance.
+        '''
+        if abs(len(a) - len(b)) > max_distance:
+            return max_distance + 1
+        previous = range(len(b) + 1)
+        for i, ca in enumerate(a, 1):
+            current = [i]
+            for j, cb in enumerate(b, 1):
+                current.append(min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + (ca != cb)))
+            if min(current) > max_distance:
+                return max_distance + 1
+            previous = current
+        return previous[-1]
+
+    def get_rows(self, country_code, name):
+        return [self.official_data[p] for p in self.name_positions[(country_code, name)]]
+
+    def prefix_candidates(self, country_code, prefix, limit=10):
+        '''
+        Official names starting with prefix, in sorted order.
+        '''
+        prefix = self.normalize_name(prefix)
+        names = self.sorted_names.get(country_code, [])
+        result = []
+        i = bisect.bisect_left(names, prefix)
+        while i < len(names) and names[i].startswith(prefix) and len(result) < limit:
+            result.append(names[i])
+            i += 1
+        return result
+
+    def fuzzy_candidates(self, country_code, name, limit=10, max_distance=2):
+        '''
+        [(edit_distance, official name), ...] sorted by distance, for names within max_distance edits.
+        '''
+        name = self.normalize_name(name)
+        ngrams = set(self.get_ngrams(name))
+        # each edit destroys at most NGRAM_SIZE ngrams
+        min_common = len(ngrams) - max_distance * self.NGRAM_SIZE
+        common = defaultdict(int)
+        for length in range(max(1, len(name) - max_distance), len(name) + max_distance + 1):
+            for ngram in ngrams:
+                for candidate in self.ngram_names.get((country_code, ngram, length), ()):
+                    common[candidate] += 1
+        result = []
+        for candidate, count in common.iteritems():
+            if count < min_common:
+                continue
+            distance = self.get_edit_distance(name, candidate, max_distance)
+            if distance <= max_distance:
+                result.append((distance, candidate))
+        result.sort()
+        return result[:limit]
+
+
+
 class CityManager(object):
+    # bump when GeonamesCity fields or index tables change, so old snapshots get rebuilt
+    OFFICIAL_SNAPSHOT_VERSION = 3
+    # GeonamesRegionTables set by load_region_tables; without them only countries and regions
+    # of the hand-written maps below are supported
+    region_tables = None
+
     FORCE_MATCHIING_MAP = [
        # (original, real_match)
        ({'country': 'United States', 'region': '', 'employers_count': '401', 'city': 'newyork'}, {'country': 'United States', 'region': 'NY', 'employers_count': '401', 'city': 'new york city'} ),
@@ -72,6 +349,7 @@ class CityManager(object):
         'Australia': 'AU',
         'Canada': 'CA',
     }
+    CUSTOM_COUNTRY_CODES = frozenset(CUSTOM_COUNTRY_NAME_TO_ISO_3166_2_CODE.values())
     CUSTOM_REGION_NAME_TO_ADMIN1_CODE = {
         'US.AR': 'US.AR',
         'US.DC': 'US.DC',
@@ -138,98 +416,142 @@ class CityManager(object):
         'CA.YT': 'CA.12',
         'CA.NL': 'CA.05',
     }
+    ADMIN1_CODE_TO_REGION_NAME = {
+        'AU.08': 'Western Australia',
+        'AU.05': 'South Australia',
+        'AU.03': 'Northern Territory',
+        'AU.07': 'Victoria',
+        'AU.06': 'Tasmania',
+        'AU.04': 'Queensland',
+        'AU.02': 'New South Wales',
+        'AU.01': 'Australian Capital Territory',
+        'CA.01': 'Alberta',
+        'CA.02': 'British Columbia',
+        'CA.03': 'Manitoba',
+        'CA.04': 'New Brunswick',
+        'CA.13': 'Northwest Territories',
+        'CA.07': 'Nova Scotia',
+        'CA.14': 'Nunavut',
+        'CA.08': 'Ontario',
+        'CA.09': 'Prince Edward Island',
+        'CA.10': 'Quebec',
+        'CA.11': 'Saskatchewan',
+        'CA.12': 'Yukon',
+        'CA.05': 'Newfoundland and Labrador',
+        'GB.WLS': 'Wales',
+        'GB.SCT': 'Scotland',
+        'GB.NIR': 'N Ireland',
+        'GB.ENG': 'England',
+        'US.AR': 'Arkansas',
+        'US.DC': 'Washington, D.C.',
+        'US.DE': 'Delaware',
+        'US.FL': 'Florida',
+        'US.GA': 'Georgia',
+        'US.KS': 'Kansas',
+        'US.LA': 'Louisiana',
+        'US.MD': 'Maryland',
+        'US.MO': 'Missouri',
+        'US.MS': 'Mississippi',
+        'US.NC': 'North Carolina',
+        'US.OK': 'Oklahoma',
+        'US.SC': 'South Carolina',
+        'US.TN': 'Tennessee',
+        'US.TX': 'Texas',
+        'US.WV': 'West Virginia',
+        'US.AL': 'Alabama',
+        'US.CT': 'Connecticut',
+        'US.IA': 'Iowa',
+        'US.IL': 'Illinois',
+        'US.IN': 'Indiana',
+        'US.ME': 'Maine',
+        'US.MI': 'Michigan',
+        'US.MN': 'Minnesota',
+        'US.NE': 'Nebraska',
+        'US.NH': 'New Hampshire',
+        'US.NJ': 'New Jersey',
+        'US.NY': 'New York',
+        'US.OH': 'Ohio',
+        'US.RI': 'Rhode Island',
+        'US.VT': 'Vermont',
+        'US.WI': 'Wisconsin',
+        'US.CA': 'California',
+        'US.CO': 'Colorado',
+        'US.NM': 'New Mexico',
+        'US.NV': 'Nevada',
+        'US.UT': 'Utah',
+        'US.AZ': 'Arizona',
+        'US.ID': 'Idaho',
+        'US.MT': 'Montana',
+        'US.ND': 'North Dakota',
+        'US.OR': 'Oregon',
+        'US.SD': 'South Dakota',
+        'US.WA': 'Washington',
+        'US.WY': 'Wyoming',
+        'US.HI': 'Hawaii',
+        'US.AK': 'Alaska',
+        'US.KY': 'Kentucky',
+        'US.MA': 'Massachusetts',
+        'US.PA': 'Pennsylvania',
+        'US.VA': 'Virginia',
+    }
 
     @classmethod
     def get_region(self, official_data_row):
-        return {
-            'AU.08': 'Western Australia',
-            'AU.05': 'South Australia',
-            'AU.03': 'Northern Territory',
-            'AU.07': 'Victoria',
-            'AU.06': 'Tasmania',
-            'AU.04': 'Queensland',
-            'AU.02': 'New South Wales',
-            'AU.01': 'Australian Capital Territory',
-            'CA.01': 'Alberta',
-            'CA.02': 'British Columbia',
-            'CA.03': 'Manitoba',
-            'CA.04': 'New Brunswick',
-            'CA.13': 'Northwest Territories',
-            'CA.07': 'Nova Scotia',
-            'CA.14': 'Nunavut',
-            'CA.08': 'Ontario',
-            'CA.09': 'Prince Edward Island',
-            'CA.10': 'Quebec',
-            'CA.11': 'Saskatchewan',
-            'CA.12': 'Yukon',
-            'CA.05': 'Newfoundland and Labrador',
-            'GB.WLS': 'Wales',
-            'GB.SCT': 'Scotland',
-            'GB.NIR': 'N Ireland',
-            'GB.ENG': 'England',
-            'US.AR': 'Arkansas',
-            'US.DC': 'Washington, D.C.',
-            'US.DE': 'Delaware',
-            'US.FL': 'Florida',
-            'US.GA': 'Georgia',
-            'US.KS': 'Kansas',
-            'US.LA': 'Louisiana',
-            'US.MD': 'Maryland',
-            'US.MO': 'Missouri',
-            'US.MS': 'Mississippi',
-            'US.NC': 'North Carolina',
-            'US.OK': 'Oklahoma',
-            'US.SC': 'South Carolina',
-            'US.TN': 'Tennessee',
-            'US.TX': 'Texas',
-            'US.WV': 'West Virginia',
-            'US.AL': 'Alabama',
-            'US.CT': 'Connecticut',
-            'US.IA': 'Iowa',
-            'US.IL': 'Illinois',
-            'US.IN': 'Indiana',
-            'US.ME': 'Maine',
-            'US.MI': 'Michigan',
-            'US.MN': 'Minnesota',
-            'US.NE': 'Nebraska',
-            'US.NH': 'New Hampshire',
-            'US.NJ': 'New Jersey',
-            'US.NY': 'New York',
-            'US.OH': 'Ohio',
-            'US.RI': 'Rhode Island',
-            'US.VT': 'Vermont',
-            'US.WI': 'Wisconsin',
-            'US.CA': 'California',
-            'US.CO': 'Colorado',
-            'US.NM': 'New Mexico',
-            'US.NV': 'Nevada',
-            'US.UT': 'Utah',
-            'US.AZ': 'Arizona',
-            'US.ID': 'Idaho',
-            'US.MT': 'Montana',
-            'US.ND': 'North Dakota',
-            'US.OR': 'Oregon',
-            'US.SD': 'South Dakota',
-            'US.WA': 'Washington',
-            'US.WY': 'Wyoming',
-            'US.HI': 'Hawaii',
-            'US.AK': 'Alaska',
-            'US.KY': 'Kentucky',
-            'US.MA': 'Massachusetts',
-            'US.PA': 'Pennsylvania',
-            'US.VA': 'Virginia',
-        }['%s.%s' % (official_data_row['country_code'], official_data_row['admin1_code'])]
-
-    @classmethod
-    def process(self, custom_db, official_db, target_db):
-        cities = self.get_cities(
-            self.load_custom_data(custom_db),
-            self.load_official_data(official_db)
-        )
-        self.write_csv(cities, target_db)
+        key = '%s.%s' % (official_data_row['country_code'], official_data_row['admin1_code'])
+        if self.region_tables and key not in self.ADMIN1_CODE_TO_REGION_NAME:
+            return self.region_tables.admin1_names.get(key, '')
+        return self.ADMIN1_CODE_TO_REGION_NAME[key]
 
     @classmethod
-    def write_csv(self, data, target_db):
+    def process(self, custom_db, official_db, target_db, official_snapshot_db=None, store=None, admin1_codes_db=None, country_info_db=None, report_candidates=False, employers_count_db=None):
+        '''
+        With admin1_codes_db and country_info_db (GeoNames admin1CodesASCII.txt and countryInfo.txt) cities
+        of all countries are matched, see load_region_tables.
+        With report_candidates prefix/fuzzy candidates of rows without a direct match are reported (see get_candidates).
+        With employers_count_db employers_count of custom rows matched to each city is written there
+        (geonameid, employers_count), used to prioritize API queries by create-city-skills-users-db.py.
+        '''
+        metrics = locallib.metrics
+        if admin1_codes_db and country_info_db:
+            self.load_region_tables(admin1_codes_db, country_info_db)
+        with metrics.phase('load') as phase:
+            if official_snapshot_db:
+                official_data, official_index = self.load_official_snapshot(official_db, official_snapshot_db)
+            else:
+                official_data, official_index = self.load_official_data(official_db), None
+            candidate_index = None
+            if report_candidates:
+                candidate_index = self.load_candidate_index(official_db, official_data, self.get_candidate_snapshot_path(official_snapshot_db) if official_snapshot_db else None)
+            custom_data = self.load_custom_data(custom_db)
+            phase['rows'] = len(official_data) + len(custom_data)
+        employers_counts = {}
+        with metrics.phase('match') as phase:
+            cities = self.get_cities(
+                custom_data,
+                official_data,
+                official_index,
+                candidate_index,
+                report_candidates,
+                employers_counts,
+            )
+            phase['rows'] = len(custom_data)
+        with metrics.phase('write') as phase:
+            rows = self.get_csv_rows(cities)
+            self.write_csv(rows, target_db)
+            if store:
+                store.write_cities(rows)
+            if employers_count_db:
+                self.write_csv(sorted([geonameid.encode('utf8'), '%d' % count] for geonameid, count in employers_counts.iteritems()), employers_count_db)
+            phase['rows'] = len(rows)
+
+    @classmethod
+    def write_csv(self, rows, target_db):
+        with open(target_db, 'wb') as csvfile:
+            writer = csv.writer(csvfile)
+            writer.writerows(rows)
+
+    @classmethod
+    def get_csv_rows(self, data):
         fields = [
             'geonameid',
             'name',
@@ -239,42 +561,33 @@ class CityManager(object):
             'longitude',
             'latitude',
         ]
-        with open(target_db, 'wb') as csvfile:
-            writer = csv.writer(csvfile)
-            for city in data:
-                city['custom_region'] = self.get_region(city)
-                row = []
-                for f in fields:
-                    row.append(city[f].encode('utf8'))
-                writer.writerow(row)
+        rows = []
+        for city in data:
+            row = []
+            for f in fields:
+                value = self.get_region(city) if f == 'custom_region' else city[f]
+                row.append(value.encode('utf8'))
+            rows.append(row)
+        return rows
 
     @classmethod
-    def get_cities(self, custom_data, official_data):
-        matched = defaultdict(list)
-        not_matched_directly = []
-        total_employeer_count = 0
-        matched_employeer_count = 0
-        for row in custom_data:
-            total_employeer_count += int(row['employers_count'])
-            city_matched = False
-            key = tuple(sorted(row.items()))
-            for offical_row in official_data:
-                if self.row_match(row, offical_row):
-                    city_matched = True
-                    matched[key].append(offical_row)
-                    # we don't want to count duplicates
-                    if len(matched[key]) == 1:
-                        matched_employeer_count += int(row['employers_count'])
-
-            if not city_matched:
-                not_matched_directly.append(row)
+    def get_cities(self, custom_data, official_data, official_index=None, candidate_index=None, report_candidates=False, employers_counts=None):
+        '''
+        Official cities matched by custom rows. If employers_counts dict is given, it's filled with
+        {geonameid: employers_count summed over the (distinct) custom rows matched to the city}.
+        '''
+        matched, not_matched_directly, total_employeer_count, matched_employeer_count = self.match_rows(custom_data, official_data, official_index)
 
         singlematch_count = len([v for v in matched.values() if len(v) == 1])
         multimatch_count = len([v for v in matched.values() if len(v) > 1])
         # {custom_row => list(official_row), ...} to [offical_row, ...]
         official_cities = [v[0] for v in self.remove_duplicate_matches(matched).values()]
+        if employers_counts is not None:
+            for key, official_rows in matched.iteritems():
+                geonameid = official_rows[0]['geonameid']
+                employers_counts[geonameid] = employers_counts.get(geonameid, 0) + int(dict(key)['employers_count'])
         # remove duplicated entries from list of cities
-        official_cities = [dict(t) for t in set([tuple(sorted(d.items())) for d in official_cities])]
+        official_cities = {c['geonameid']: c for c in official_cities}.values()
 
         print 'CITIES TO BE MATCHED (dirty data, contains duplicates and incorrect cities): %d' % len(custom_data)
         print 'DIRTY CITY MATCHED DIRECTLY (only one match found): %d' % singlematch_count
@@ -285,8 +598,89 @@ class CityManager(object):
         print 'DIRECTLY MATCHED EMPLOYEER COUNT: %d' % matched_employeer_count
         print 'DIRECTLY/TOTAL RADIO: %.1f' % ((float(matched_employeer_count)/total_employeer_count) * 100)
 
+        print 'NOT MATCHED DIRECTLY: %d' % len(not_matched_directly)
+        if report_candidates:
+            candidates = self.get_candidates(not_matched_directly, official_data, candidate_index)
+            print 'NOT MATCHED DIRECTLY, PREFIX/FUZZY CANDIDATES FOUND: %d' % len([c for c in candidates.values() if c])
+
         return official_cities
 
+    @classmethod
+    def match_rows(self, custom_data, official_data, official_index=None):
+        '''
+        Match custom rows against official data using OfficialCityIndex (one dict lookup per custom row).
+        '''
+        official_index = official_index or OfficialCityIndex(official_data)
+        return self.collect_matches(custom_data, lambda row: official_index.lookup(self, row))
+
+    @classmethod
+    def match_rows_nested_loop(self, custom_data, official_data):
+        '''
+        Reference matcher comparing every custom row with every official row. Slow, used only by verify_matching.
+        '''
+        return self.collect_matches(custom_data, lambda row: [offical_row for offical_row in official_data if self.row_match(row, offical_row)])
+
+    @classmethod
+    def collect_matches(self, custom_data, find_matches):
+        matched = defaultdict(list)
+        not_matched_directly = []
+        total_employeer_count = 0
+        matched_employeer_count = 0
+        for row in custom_data:
+            total_employeer_count += int(row['employers_count'])
+            key = tuple(sorted(row.items()))
+            official_rows = find_matches(row)
+            if official_rows:
+                matched[key].extend(official_rows)
+                # we don't want to count duplicates
+                if len(matched[key]) == len(official_rows):
+                    matched_employeer_count += int(row['employers_count'])
+            else:
+                not_matched_directly.append(row)
+        return matched, not_matched_directly, total_employeer_count, matched_employeer_count
+
+    @classmethod
+    def verify_matching(self, custom_data, official_data):
+        '''
+        Check that indexed matching gives exactly the same results as the nested loop matcher.
+        '''
+        indexed = self.match_rows(custom_data, official_data)
+        nested_loop = self.match_rows_nested_loop(custom_data, official_data)
+        if indexed != nested_loop:
+            raise Exception('Indexed matching differs from nested loop matching.')
+        print 'OK: indexed matching equals nested loop matching (%d custom rows, %d official rows)' % (len(custom_data), len(official_data))
+
+    @classmethod
+    def get_candidates(self, custom_data, official_data, candidate_index=None, limit=5, max_distance=2):
+        '''
+        Ranked official row candidates for custom rows without a direct match: {custom_row_key: [official_row, ...], ...}.
+
+        Prefix matches rank first, then fuzzy matches by edit distance; rows in the custom region
+        and with larger population rank first within the same name.
+        '''
+        candidate_index = candidate_index or CityNameCandidateIndex(official_data)
+        result = {}
+        for row in custom_data:
+            row = self.force_match(row)
+            country_code = self.custom_country_name_to_ISO_3166_2_code(row['country'])
+            admin1_code = None
+            if row['region'] not in ('', '-'):
+                try:
+                    admin1_code = self.get_admin1_code(row['country'], row['region'])
+                except Exception:
+                    # unsupported region, candidates are ranked without it
+                    pass
+            ranked_names = [(0, n) for n in candidate_index.prefix_candidates(country_code, row['city'], limit)]
+            ranked_names += [(1 + d, n) for d, n in candidate_index.fuzzy_candidates(country_code, row['city'], limit, max_distance)]
+            ranked = {}
+            for rank, name in ranked_names:
+                for offical_row in candidate_index.get_rows(country_code, name):
+                    sort_key = (rank, offical_row['admin1_code'] != admin1_code, -int(offical_row['population'] or 0))
+                    if offical_row['geonameid'] not in ranked or sort_key < ranked[offical_row['geonameid']][0]:
+                        ranked[offical_row['geonameid']] = (sort_key, offical_row)
+            result[tuple(sorted(row.items()))] = [r for _, r in sorted(ranked.values(), key=lambda v: v[0])][:limit]
+        return result
+
     @classmethod
     def remove_duplicate_matches(self, data):
         for key, duplicates in data.iteritems():
@@ -297,10 +691,7 @@ class CityManager(object):
 
     @classmethod
     def row_match(self, custom_data_row, official_data_row, skip_region=False, match_if_matching_prefix=False):
-        for k,v in self.FORCE_MATCHIING_MAP:
-            if k == custom_data_row:
-                custom_data_row = v
-                break
+        custom_data_row = self.force_match(custom_data_row)
 
         try:
             assert self.custom_country_name_to_ISO_3166_2_code(custom_data_row['country']) == official_data_row['country_code']
@@ -320,12 +711,19 @@ class CityManager(object):
                     else:
                         raise
             if custom_data_row['region'] not in ('', '-') and not skip_region:
-                assert self.custom_region_name_to_admin1_code(custom_data_row['country'], custom_data_row['region'])[-2:] == official_data_row['admin1_code']
+                assert self.get_admin1_code(custom_data_row['country'], custom_data_row['region']) == official_data_row['admin1_code']
             return True
         except AssertionError:
             return False
 
 
+    @classmethod
+    def force_match(self, custom_data_row):
+        for k,v in self.FORCE_MATCHIING_MAP:
+            if k == custom_data_row:
+                return v
+        return custom_data_row
+
     @classmethod
     def load_custom_data(self, path):
         with open(path , 'rb') as csv_file:
@@ -334,9 +732,147 @@ class CityManager(object):
 
     @classmethod
     def load_official_data(self, path):
-        with open(path , 'rb') as csv_file:
-            reader = GeonamesCityListImporter(csv_file, delimiter=GeonamesCityListImporter.DELIMITER, quotechar=GeonamesCityListImporter.QUOTECHAR)
-            return [self.decode_row(row) for row in reader if not self.skip_official_db_row(row)]
+        '''
+        Stream GeoNames rows, skipping rows by the raw country_code column before anything is decoded,
+        and keep the rest as compact GeonamesCity records.
+
+        path may be the extracted .txt file, the downloaded .zip archive or a .gz file.
+        '''
+        country_code_column = GeonamesCityListImporter.fieldnames.index('country_code')
+        data = []
+        read_count = 0
+        start = time.time()
+        with self.open_official_data(path) as csv_file:
+            reader = csv.reader(csv_file, delimiter=GeonamesCityListImporter.DELIMITER, quotechar=GeonamesCityListImporter.QUOTECHAR)
+            for row in reader:
+                read_count += 1
+                if not self.skip_official_db_row(row[country_code_column]):
+                    data.append(GeonamesCity.from_raw_row(row))
+        elapsed = time.time() - start
+        print 'OFFICIAL ROWS READ: %d, KEPT: %d (%.1fs, %d rows/sec)' % (read_count, len(data), elapsed, read_count / max(elapsed, 0.001))
+        return data
+
+    @classmethod
+    def load_official_snapshot(self, path, snapshot_path):
+        '''
+        Load filtered official data and its OfficialCityIndex from the snapshot file, (re)building the
+        snapshot when it is missing or stale (see get_snapshot_key).
+
+        Returns (official_data, OfficialCityIndex).
+        '''
+        key = self.get_snapshot_key(path)
+        start = time.time()
+        snapshot = self.read_snapshot(snapshot_path, key)
+        if snapshot is not None:
+            rows, official_index_tables = snapshot
+            official_data = [GeonamesCity(*row) for row in rows]
+            print 'OFFICIAL SNAPSHOT LOADED: %d rows (%.1fs)' % (len(official_data), time.time() - start)
+            return official_data, OfficialCityIndex(official_data, official_index_tables)
+
+        print 'OFFICIAL SNAPSHOT MISSING OR STALE, REBUILDING: %s' % snapshot_path
+        official_data = self.load_official_data(path)
+        official_index = OfficialCityIndex(official_data)
+        rows = [tuple(row[f] for f in GeonamesCity.__slots__) for row in official_data]
+        self.write_snapshot(snapshot_path, key, (rows, official_index.get_tables()))
+        return official_data, official_index
+
+    @classmethod
+    def load_candidate_index(self, path, official_data, snapshot_path=None):
+        '''
+        CityNameCandidateIndex of official_data (loaded from path), only needed for the candidate report.
+        With snapshot_path its tables are stored there (separately from the official snapshot, which
+        doesn't need them) and reused while the snapshot key (see get_snapshot_key) is the same.
+        '''
+        key = self.get_snapshot_key(path)
+        if snapshot_path:
+            tables = self.read_snapshot(snapshot_path, key)
+            if tables is not None:
+                return CityNameCandidateIndex(official_data, tables)
+        candidate_index = CityNameCandidateIndex(official_data, alternatenames=self.load_official_alternatenames(path))
+        if snapshot_path:
+            self.write_snapshot(snapshot_path, key, candidate_index.get_tables())
+        return candidate_index
+
+    @classmethod
+    def load_official_alternatenames(self, path):
+        '''
+        {geonameid: alternatenames} of official rows kept by load_official_data, read from the dump again
+        (alternatenames is the largest column and only the candidate index uses it).
+        '''
+        country_code_column = GeonamesCityListImporter.fieldnames.index('country_code')
+        geonameid_column = GeonamesCityListImporter.fieldnames.index('geonameid')
+        alternatenames_column = GeonamesCityListImporter.fieldnames.index('alternatenames')
+        data = {}
+        with self.open_official_data(path) as csv_file:
+            reader = csv.reader(csv_file, delimiter=GeonamesCityListImporter.DELIMITER, quotechar=GeonamesCityListImporter.QUOTECHAR)
+            for row in reader:
+                if not self.skip_official_db_row(row[country_code_column]) and row[alternatenames_column]:
+                    data[row[geonameid_column].decode('utf8')] = row[alternatenames_column].decode('utf8')
+        return data
+
+    @classmethod
+    def get_candidate_snapshot_path(self, snapshot_path):
+        return snapshot_path + '.candidates'
+
+    @classmethod
+    def get_snapshot_key(self, path):
+        '''
+        Snapshots are keyed on the source file path, size and mtime and on the official country filter.
+        '''
+        source_stat = os.stat(path)
+        return (
+            self.OFFICIAL_SNAPSHOT_VERSION,
+            os.path.abspath(path),
+            source_stat.st_size,
+            source_stat.st_mtime,
+            tuple(sorted(self.get_country_codes())),
+        )
+
+    @classmethod
+    def read_snapshot(self, snapshot_path, key):
+        '''
+        Data stored by write_snapshot with the same key, or None.
+        '''
+        try:
+            with open(snapshot_path, 'rb') as f:
+                if marshal.load(f) == key:
+                    return marshal.load(f)
+        except (IOError, EOFError, ValueError, TypeError):
+            pass
+        return None
+
+    @classmethod
+    def write_snapshot(self, snapshot_path, key, data):
+        tmp_path = snapshot_path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            marshal.dump(key, f)
+            marshal.dump(data, f)
+        os.rename(tmp_path, snapshot_path)
+
+    @classmethod
+    @contextmanager
+    def open_official_data(self, path):
+        '''
+        Open GeoNames dump for reading; .zip and .gz files are decompressed on the fly.
+        For .zip the member named like the archive (cities1000.zip => cities1000.txt) is read,
+        otherwise the only .txt member.
+        '''
+        if path.endswith('.zip'):
+            with zipfile.ZipFile(path) as archive:
+                member = os.path.splitext(os.path.basename(path))[0] + '.txt'
+                if member not in archive.namelist():
+                    members = [n for n in archive.namelist() if n.endswith('.txt')]
+                    if len(members) != 1:
+                        raise Exception('Unable to choose GeoNames file in "%s" from: %s.' % (path, ', '.join(archive.namelist())))
+                    member = members[0]
+                with closing(archive.open(member)) as f:
+                    yield f
+        elif path.endswith('.gz'):
+            with closing(gzip.open(path, 'rb')) as f:
+                yield f
+        else:
+            with open(path, 'rb') as f:
+                yield f
 
     @classmethod
     def skip_custom_db_row(self, row):
@@ -344,9 +880,30 @@ class CityManager(object):
         return False
 
     @classmethod
-    def skip_official_db_row(self, row):
-        #return row['country_code'] != 'AU'
-        return row['country_code'] not in self.CUSTOM_COUNTRY_NAME_TO_ISO_3166_2_CODE.values()
+    def skip_official_db_row(self, country_code):
+        #return country_code != 'AU'
+        return country_code not in self.get_country_codes()
+
+    @classmethod
+    def get_country_codes(self):
+        '''
+        Countries of official rows kept for matching.
+        '''
+        return self.region_tables.country_names if self.region_tables else self.CUSTOM_COUNTRY_CODES
+
+    @classmethod
+    def load_region_tables(self, admin1_codes_db, country_info_db):
+        '''
+        Use GeoNames country and admin1 tables for country, region and region name lookups of all countries.
+        The hand-written maps still take precedence (custom names like "ON" and region names used so far).
+        If a table file doesn't exist, only the hand-written maps are used.
+        '''
+        missing = [path for path in (admin1_codes_db, country_info_db) if not os.path.exists(path)]
+        if missing:
+            print 'REGION TABLES NOT FOUND (%s), ONLY BUILT-IN COUNTRIES AND REGIONS ARE SUPPORTED' % ', '.join(missing)
+            self.region_tables = None
+            return
+        self.region_tables = GeonamesRegionTables.load(admin1_codes_db, country_info_db)
 
     @classmethod
     def decode_row(self, row_dict, encoding='utf8'):
@@ -357,25 +914,62 @@ class CityManager(object):
 
     @classmethod
     def custom_country_name_to_ISO_3166_2_code(self, name):
-        try:
-            return self.CUSTOM_COUNTRY_NAME_TO_ISO_3166_2_CODE[name]
-        except KeyError:
+        code = self.CUSTOM_COUNTRY_NAME_TO_ISO_3166_2_CODE.get(name)
+        if code is None and self.region_tables:
+            code = self.region_tables.country_codes.get(name.lower())
+        if code is None:
             raise Exception('Unsupoorted country "%s".' % name)
+        return code
 
     @classmethod
     def custom_region_name_to_admin1_code(self, custom_country, custom_region):
-        key = '%s.%s' % (self.custom_country_name_to_ISO_3166_2_code(custom_country), custom_region)
-        try:
-            return self.CUSTOM_REGION_NAME_TO_ADMIN1_CODE[key]
-        except KeyError:
+        country_code = self.custom_country_name_to_ISO_3166_2_code(custom_country)
+        code = self.CUSTOM_REGION_NAME_TO_ADMIN1_CODE.get('%s.%s' % (country_code, custom_region))
+        if code is None and self.region_tables:
+            code = self.region_tables.admin1_codes.get((country_code, custom_region.lower()))
+        if code is None:
             raise Exception('Unsupoorted region "%s" for country "%s".' % (custom_region, custom_country))
+        return code
 
+    @classmethod
+    def get_admin1_code(self, custom_country, custom_region):
+        '''
+        admin1_code column value of official rows in the custom region ('CA.08' => '08', 'GB.ENG' => 'ENG').
+        '''
+        return self.custom_region_name_to_admin1_code(custom_country, custom_region).split('.', 1)[1]
 
-if __name__ == '__main__':
-    config = locallib.get_config()
-    print CityManager.process(
+
+def run(config, store=None):
+    '''
+    Process configured by config; store defaults to the configured OutputStore.
+    '''
+    CityManager.process(
         locallib.get_absolute_path(config.get('input','custom_city_db_path')),
         locallib.get_absolute_path(config.get('input','official_city_db_path')),
         locallib.get_absolute_path(config.get('output', 'target_city_db_path')),
+        locallib.get_absolute_path(config.get('cache', 'official_city_snapshot_path')) if config.has_option('cache', 'official_city_snapshot_path') else None,
+        store or locallib.get_output_store(config),
+        locallib.get_absolute_path(config.get('input', 'admin1_codes_db_path')) if config.has_option('input', 'admin1_codes_db_path') else None,
+        locallib.get_absolute_path(config.get('input', 'country_info_db_path')) if config.has_option('input', 'country_info_db_path') else None,
+        '--candidates' in sys.argv,
+        locallib.get_absolute_path(config.get('output', 'target_city_employers_count_db_path')) if config.has_option('output', 'target_city_employers_count_db_path') else None,
     )
 
+
+if __name__ == '__main__':
+    config = locallib.get_config()
+    if '--verify' in sys.argv:
+        if config.has_option('input', 'admin1_codes_db_path') and config.has_option('input', 'country_info_db_path'):
+            CityManager.load_region_tables(
+                locallib.get_absolute_path(config.get('input', 'admin1_codes_db_path')),
+                locallib.get_absolute_path(config.get('input', 'country_info_db_path')),
+            )
+        CityManager.verify_matching(
+            CityManager.load_custom_data(locallib.get_absolute_path(config.get('input','custom_city_db_path'))),
+            CityManager.load_official_data(locallib.get_absolute_path(config.get('input','official_city_db_path'))),
+        )
+        sys.exit()
+    try:
+        run(config)
+    finally:
+        locallib.write_metrics_report(config, 'create-city-db')
@@ -1,20 +1,34 @@
 # coding: utf-8
 from __future__ import unicode_literals
+import bisect
 import csv
-from itertools import combinations
-from math import radians, cos, sin, asin, sqrt
+import multiprocessing
+import os
+import sys
+from collections import defaultdict
+from itertools import product
+from math import radians, cos, sin, asin, sqrt, floor, pi
 import locallib
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 
 
 '''
-Script parses custom city list, finds pairs with distance <= MAX_CITY_DISTANCE and writes matches to CSV file.
+Script parses custom city list, finds pairs with distance <= MAX_CITY_DISTANCE (or the largest of configured radius bands)
+and writes matches (tagged with their radius band, when several bands are configured) to CSV file.
 '''
 
 
 
 MAX_CITY_DISTANCE = 50 # miles
 EARTH_RADIUS_MILES = 3963
+# vectorized distances closer than this to MAX_CITY_DISTANCE or to a rounding boundary are recomputed with the scalar formula
+DISTANCE_RECHECK_EPSILON = 1e-6
+# shards per worker process in parallel mode, more shards balance uneven city density better
+SHARDS_PER_WORKER = 4
 
 
 
@@ -31,17 +45,293 @@ class CustomCityListImporter(csv.DictReader):
 
 
 
+class CityGrid(object):
+    '''
+    Spatial index of cities for neighbor search.
+
+    Cities are bucketed by their unit-sphere (x, y, z) coordinates into cubic cells with edge
+    slightly longer than the chord of max_distance, so every city within max_distance of a city
+    lies in its cell or one of the 26 adjacent cells. Works across the poles and the antimeridian.
+    '''
+    def __init__(self, cities, max_distance):
+        # chord length of the great circle arc, with a margin for float rounding
+        self.cell_size = 2 * sin(min(pi / 2, max_distance / (2.0 * EARTH_RADIUS_MILES))) * 1.001 + 1e-9
+        self.cells = defaultdict(list)
+        for i, city in enumerate(cities):
+            self.cells[self.get_cell(city)].append(i)
+
+    def get_cell(self, city):
+        lon, lat = radians(city['longitude']), radians(city['latitude'])
+        x, y, z = cos(lat) * cos(lon), cos(lat) * sin(lon), sin(lat)
+        return int(floor(x / self.cell_size)), int(floor(y / self.cell_size)), int(floor(z / self.cell_size))
+
+    def get_candidates(self, city):
+        '''
+        Indexes of cities which may be within max_distance of city (superset, includes city itself).
+        '''
+        cx, cy, cz = self.get_cell(city)
+        candidates = []
+        for cell in product((cx - 1, cx, cx + 1), (cy - 1, cy, cy + 1), (cz - 1, cz, cz + 1)):
+            candidates.extend(self.cells.get(cell, ()))
+        return candidates
+
+
+
+# worker process state for get_city_pairs_shard, set up by init_city_pairs_worker
+city_pairs_worker = {}
+
+
+def init_city_pairs_worker(data, bands):
+    city_pairs_worker['data'] = data
+    city_pairs_worker['bands'] = bands
+    city_pairs_worker['grid'] = CityGrid(data, max(bands))
+
+
+def get_city_pairs_shard(shard):
+    start, end = shard
+    return CityDistanceManager.get_city_pairs(city_pairs_worker['data'], city_pairs_worker['bands'], start=start, end=end, grid=city_pairs_worker['grid'])
+
+
+
 class CityDistanceManager(object):
     @classmethod
-    def process(self, city_db, city_distance_db):
-        data = self.load_custom_data(city_db)
-        result = []
-        for city1, city2 in combinations(data, 2):
-            distance = self.get_cities_distance_miles(city1, city2)
-            if distance <= MAX_CITY_DISTANCE:
-                result.append([city1['geonameid'], city2['geonameid'], '%.0f' % distance])
-        self.write_csv(result, city_distance_db)
+    def process(self, city_db, city_distance_db, workers=1, bands=None, incremental=False, store=None):
+        '''
+        bands is a list of radiuses (miles); all pairs within the largest one are written and, with more
+        than one band, tagged with the smallest band they fall in. Defaults to [MAX_CITY_DISTANCE].
+
+        With store (locallib.OutputStore) cities are read from and pairs are also written to the store;
+        its cities must have been written by create-city-db.py after city_db (see OutputStore.check_up_to_date).
+
+        With incremental=True the existing distance DB is updated using get_city_pairs_incremental
+        when its city manifest (see write_manifest) is available and was written with the same bands.
+        '''
+        metrics = locallib.metrics
+        bands = sorted(bands or [MAX_CITY_DISTANCE])
+        with metrics.phase('load') as phase:
+            if store:
+                store.check_up_to_date('cities', city_db)
+            print 'CITIES READ FROM %s' % (store or city_db)
+            data = [self.decode_row(row) for row in store.get_cities()] if store else self.load_custom_data(city_db)
+            manifest = self.load_manifest(city_distance_db) if incremental else None
+            phase['rows'] = len(data)
+        with metrics.phase('distance') as phase:
+            if manifest is not None and manifest[0] == bands:
+                result = self.get_city_pairs_incremental(data, bands, manifest[1], self.load_city_pairs(city_distance_db))
+            elif workers > 1:
+                result = self.get_city_pairs_parallel(data, bands, workers)
+            else:
+                result = self.get_city_pairs(data, bands)
+            phase['rows'] = len(data)
+        with metrics.phase('write') as phase:
+            # distance DB and manifest are written to temporary files and renamed once both are complete,
+            # the old manifest is removed first, so an interrupted run never leaves a manifest not matching the DB
+            tmp_city_distance_db = city_distance_db + '.tmp'
+            self.write_csv(result, tmp_city_distance_db)
+            self.write_manifest(data, bands, tmp_city_distance_db)
+            if store:
+                store.write_city_distances(result)
+            if os.path.exists(self.get_manifest_path(city_distance_db)):
+                os.remove(self.get_manifest_path(city_distance_db))
+            os.rename(tmp_city_distance_db, city_distance_db)
+            os.rename(self.get_manifest_path(tmp_city_distance_db), self.get_manifest_path(city_distance_db))
+            phase['rows'] = len(result)
         print 'Done. %d rows written' % len(result)
+        if len(bands) > 1:
+            for band in bands:
+                print 'BAND %g MILES: %d pairs' % (band, len([r for r in result if float(r[3]) <= band]))
+
+    @classmethod
+    def get_city_pairs_parallel(self, data, bands, workers):
+        '''
+        get_city_pairs split into index range shards of city1 computed by a pool of worker processes.
+        Shards are merged in index order, so the result is the same as from get_city_pairs.
+        '''
+        shard_count = workers * SHARDS_PER_WORKER
+        bounds = [len(data) * k // shard_count for k in range(shard_count + 1)]
+        shards = [(start, end) for start, end in zip(bounds, bounds[1:]) if start < end]
+        pool = multiprocessing.Pool(workers, init_city_pairs_worker, (data, bands))
+        try:
+            result = []
+            for shard_result in pool.imap(get_city_pairs_shard, shards):
+                result.extend(shard_result)
+            pool.close()
+        except:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+        return result
+
+    @classmethod
+    def get_city_pairs(self, data, bands, vectorized=None, start=0, end=None, grid=None):
+        '''
+        [[geonameid1, geonameid2, distance, band], ...] (see get_pair_row) for city pairs within the largest of the sorted
+        bands, in the same order as checking itertools.combinations(data, 2), but only neighbors found
+        by CityGrid are checked. Only pairs with start <= index of city1 < end are returned.
+
+        Uses get_block_distances_miles when numpy is available (unless vectorized=False).
+        '''
+        if vectorized is None:
+            vectorized = numpy is not None
+        if end is None:
+            end = len(data)
+        max_distance = bands[-1]
+        grid = grid or CityGrid(data, max_distance)
+        if vectorized:
+            return self.get_city_pairs_vectorized(data, bands, start, end, grid)
+        result = []
+        for i in xrange(start, end):
+            city1 = data[i]
+            for j in sorted(j for j in grid.get_candidates(city1) if j > i):
+                city2 = data[j]
+                distance = self.get_cities_distance_miles(city1, city2)
+                if distance <= max_distance:
+                    result.append(self.get_pair_row(city1, city2, distance, bands))
+        return result
+
+    @classmethod
+    def get_city_pairs_incremental(self, data, bands, old_coordinates, old_pairs):
+        '''
+        get_city_pairs result computed from the previous one: pairs of removed cities (or cities with
+        changed coordinates) are dropped and only pairs involving added cities are computed.
+
+        old_coordinates is {geonameid: (longitude, latitude), ...} of the city list used for old_pairs.
+        Rows are ordered as get_city_pairs orders them for data.
+        '''
+        positions = {city['geonameid']: i for i, city in enumerate(data)}
+        added = set(i for i, city in enumerate(data) if old_coordinates.get(city['geonameid']) != (city['longitude'], city['latitude']))
+        removed = set(old_coordinates) - (set(positions) - set(data[i]['geonameid'] for i in added))
+        print 'INCREMENTAL UPDATE: %d cities added or changed, %d removed or changed' % (len(added), len(removed))
+
+        pairs = []
+        for row in old_pairs:
+            if row[0] in removed or row[1] in removed:
+                continue
+            i, j = positions[row[0]], positions[row[1]]
+            pairs.append((min(i, j), max(i, j)) + tuple(row[2:]))
+
+        max_distance = bands[-1]
+        grid = CityGrid(data, max_distance)
+        for i in added:
+            for j in grid.get_candidates(data[i]):
+                # pairs of two added cities are computed once, from the lower index
+                if j == i or (j in added and j < i):
+                    continue
+                city1, city2 = data[min(i, j)], data[max(i, j)]
+                distance = self.get_cities_distance_miles(city1, city2)
+                if distance <= max_distance:
+                    pairs.append((min(i, j), max(i, j)) + tuple(self.get_pair_row(city1, city2, distance, bands)[2:]))
+        pairs.sort()
+        return [[data[pair[0]]['geonameid'], data[pair[1]]['geonameid']] + list(pair[2:]) for pair in pairs]
+
+    @classmethod
+    def get_pair_row(self, city1, city2, distance, bands):
+        '''
+        [geonameid1, geonameid2, distance, band], without band when there is only one band (the radius).
+        '''
+        row = [city1['geonameid'], city2['geonameid'], '%.0f' % distance]
+        if len(bands) > 1:
+            row.append('%g' % bands[bisect.bisect_left(bands, distance)])
+        return row
+
+    @classmethod
+    def get_city_pairs_vectorized(self, data, bands, start, end, grid):
+        '''
+        get_city_pairs computed one CityGrid cell at a time: all cities of the cell against all
+        candidates from the neighboring cells with get_block_distances_miles.
+
+        Distances within DISTANCE_RECHECK_EPSILON of a band or of a .5 rounding boundary are
+        recomputed with get_earth_dictance_miles, so the output matches the scalar version exactly.
+        '''
+        max_distance = bands[-1]
+        lons = numpy.array([c['longitude'] for c in data], dtype=numpy.float64)
+        lats = numpy.array([c['latitude'] for c in data], dtype=numpy.float64)
+        pairs = []
+        for cell_indexes in grid.cells.itervalues():
+            block1 = numpy.array([i for i in cell_indexes if start <= i < end])
+            if not len(block1):
+                continue
+            block2 = numpy.array(sorted(set(grid.get_candidates(data[cell_indexes[0]]))))
+            mask = block1[:, None] < block2[None, :]
+            mask &= self.get_bounding_box_mask(lons[block1][:, None], lats[block1][:, None], lons[block2][None, :], lats[block2][None, :], max_distance)
+            rows, columns = numpy.nonzero(mask)
+            if not len(rows):
+                continue
+            i, j = block1[rows], block2[columns]
+            distances = self.get_earth_distances_miles(lons[i], lats[i], lons[j], lats[j])
+            fraction = distances - numpy.floor(distances)
+            recheck = numpy.abs(fraction - 0.5) < DISTANCE_RECHECK_EPSILON
+            for band in bands:
+                recheck |= numpy.abs(distances - band) < DISTANCE_RECHECK_EPSILON
+            for k in numpy.nonzero(recheck)[0]:
+                distances[k] = self.get_cities_distance_miles(data[i[k]], data[j[k]])
+            within = distances <= max_distance
+            pairs.extend(zip(i[within].tolist(), j[within].tolist(), distances[within].tolist()))
+        pairs.sort()
+        return [self.get_pair_row(data[i], data[j], distance, bands) for i, j, distance in pairs]
+
+    @classmethod
+    def get_bounding_box_mask(self, lons1, lats1, lons2, lats2, max_distance):
+        '''
+        Cheap prefilter: False where the latitude or longitude delta alone proves distance > max_distance.
+        Arguments are numpy arrays (or scalars) broadcast against each other, in decimal degrees.
+        '''
+        angle = max_distance / float(EARTH_RADIUS_MILES)
+        max_dlat = numpy.degrees(angle) * 1.001 + 1e-9
+        mask = numpy.abs(lats2 - lats1) <= max_dlat
+        # widest longitude delta of a circle with angular radius angle, undefined if the circle contains a pole
+        cos_lats1 = numpy.cos(numpy.radians(lats1))
+        near_pole = numpy.abs(lats1) + max_dlat >= 90
+        max_dlon = numpy.degrees(numpy.arcsin(numpy.minimum(1, sin(angle) / numpy.maximum(cos_lats1, 1e-12)))) * 1.001 + 1e-9
+        dlon = numpy.abs(lons2 - lons1) % 360
+        dlon = numpy.minimum(dlon, 360 - dlon)
+        return mask & (near_pole | (dlon <= max_dlon))
+
+    @classmethod
+    def get_earth_distances_miles(self, lons1, lats1, lons2, lats2):
+        '''
+        Vectorized get_earth_dictance_miles: arguments are numpy arrays (or scalars) in decimal degrees,
+        broadcast against each other. One-to-many: scalar lon1/lat1 with arrays lons2/lats2.
+        '''
+        lons1, lats1, lons2, lats2 = [numpy.radians(numpy.asarray(v, dtype=numpy.float64)) for v in (lons1, lats1, lons2, lats2)]
+        dlon = lons2 - lons1
+        dlat = lats2 - lats1
+        a = numpy.sin(dlat / 2) ** 2 + numpy.cos(lats1) * numpy.cos(lats2) * numpy.sin(dlon / 2) ** 2
+        return EARTH_RADIUS_MILES * 2 * numpy.arcsin(numpy.sqrt(numpy.minimum(a, 1)))
+
+    @classmethod
+    def get_block_distances_miles(self, lons1, lats1, lons2, lats2):
+        '''
+        Block-to-block distances: matrix [len(lons1), len(lons2)] of miles between every pair of points.
+        '''
+        return self.get_earth_distances_miles(
+            numpy.asarray(lons1, dtype=numpy.float64)[:, None],
+            numpy.asarray(lats1, dtype=numpy.float64)[:, None],
+            numpy.asarray(lons2, dtype=numpy.float64)[None, :],
+            numpy.asarray(lats2, dtype=numpy.float64)[None, :],
+        )
+
+    @classmethod
+    def verify_distances(self, data):
+        '''
+        Cross-check vectorized distances against the scalar get_earth_dictance_miles reference.
+        '''
+        if numpy is None:
+            raise Exception('numpy is required for vectorized distances.')
+        sample = data[:1000]
+        lons = [c['longitude'] for c in sample]
+        lats = [c['latitude'] for c in sample]
+        block = self.get_block_distances_miles(lons, lats, lons, lats)
+        max_error = 0.0
+        for i, city1 in enumerate(sample):
+            for j, city2 in enumerate(sample):
+                max_error = max(max_error, abs(block[i, j] - self.get_cities_distance_miles(city1, city2)))
+        if max_error > 1e-6:
+            raise Exception('Vectorized distances differ from scalar ones by %g miles.' % max_error)
+        if self.get_city_pairs(data, [MAX_CITY_DISTANCE], vectorized=True) != self.get_city_pairs(data, [MAX_CITY_DISTANCE], vectorized=False):
+            raise Exception('Vectorized city pairs differ from scalar ones.')
+        print 'OK: vectorized distances equal scalar ones (%d cities, max error %g miles)' % (len(data), max_error)
 
     @classmethod
     def get_cities_distance_miles(self, city1, city2):
@@ -70,6 +360,42 @@ class CityDistanceManager(object):
         with open(target_db, 'wb') as csvfile:
             writer = csv.writer(csvfile)
             writer.writerows(data)
+            csvfile.flush()
+            os.fsync(csvfile.fileno())
+
+    @classmethod
+    def load_city_pairs(self, path):
+        with open(path, 'rb') as csv_file:
+            return list(csv.reader(csv_file))
+
+    @classmethod
+    def get_manifest_path(self, city_distance_db):
+        return city_distance_db + '.cities'
+
+    @classmethod
+    def write_manifest(self, data, bands, city_distance_db):
+        '''
+        Store bands and the city coordinates the distance DB was computed from, for incremental updates.
+        '''
+        with open(self.get_manifest_path(city_distance_db), 'wb') as csvfile:
+            writer = csv.writer(csvfile)
+            writer.writerow(['bands'] + [repr(b) for b in bands])
+            writer.writerows([city['geonameid'], repr(city['longitude']), repr(city['latitude'])] for city in data)
+            csvfile.flush()
+            os.fsync(csvfile.fileno())
+
+    @classmethod
+    def load_manifest(self, city_distance_db):
+        '''
+        (bands, {geonameid: (longitude, latitude), ...}) written by write_manifest, or None if there is none.
+        '''
+        path = self.get_manifest_path(city_distance_db)
+        if not (os.path.exists(path) and os.path.exists(city_distance_db)):
+            return None
+        with open(path, 'rb') as csv_file:
+            reader = csv.reader(csv_file)
+            bands = [float(b) for b in next(reader)[1:]]
+            return bands, {row[0]: (float(row[1]), float(row[2])) for row in reader}
 
     @classmethod
     def load_custom_data(self, path):
@@ -85,11 +411,26 @@ class CityDistanceManager(object):
 
 
 
-if __name__ == '__main__':
-    config = locallib.get_config()
-    print CityDistanceManager.process(
+def run(config, store=None):
+    '''
+    Process configured by config; store defaults to the configured OutputStore.
+    '''
+    CityDistanceManager.process(
             locallib.get_absolute_path(config.get('output', 'target_city_db_path')),
             locallib.get_absolute_path(config.get('output', 'target_city_distances_db_path')),
+            int(config.get('distance', 'workers') or multiprocessing.cpu_count()) if config.has_option('distance', 'workers') else multiprocessing.cpu_count(),
+            [float(b) for b in config.get('distance', 'radius_bands').split(',')] if config.has_option('distance', 'radius_bands') and config.get('distance', 'radius_bands') else None,
+            '--incremental' in sys.argv,
+            store or locallib.get_output_store(config),
     )
 
 
+if __name__ == '__main__':
+    config = locallib.get_config()
+    if '--verify' in sys.argv:
+        CityDistanceManager.verify_distances(CityDistanceManager.load_custom_data(locallib.get_absolute_path(config.get('output', 'target_city_db_path'))))
+        sys.exit()
+    try:
+        run(config)
+    finally:
+        locallib.write_metrics_report(config, 'create-city-distance-db')
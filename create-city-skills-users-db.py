@@ -1,8 +1,22 @@
 # coding: utf-8
 from __future__ import unicode_literals
 import csv
+import hashlib
+import imp
+import json
+import mmap
 import os
-from collections import defaultdict
+import Queue
+import random
+import socket
+import sqlite3
+import struct
+import threading
+import time
+import urllib2
+from array import array
+from collections import defaultdict, Counter, OrderedDict
+from itertools import izip
 import odesk
 import locallib
 import sys
@@ -25,6 +39,7 @@ class CustomCityDistancesImporter(csv.DictReader):
         'geonameid1',
         'geonameid2',
         'distance_in_miles',
+        'band',
     ]
 
 
@@ -42,6 +57,14 @@ class CustomCityListImporter(csv.DictReader):
 
 
 
+class CityEmployersCountImporter(csv.DictReader):
+    fieldnames = [
+        'geonameid',
+        'employers_count',
+    ]
+
+
+
 class CustomSkills1Importer(csv.DictReader):
     fieldnames = [
         'name',
@@ -62,24 +85,336 @@ class CustomSkills2Importer(csv.DictReader):
 
 
 class CityDataManager(object):
+    # query priorities available for prioritize_queries
+    PRIORITIES = (
+        'population', # city population from city_db
+        'employers_count', # employers_count of custom city list rows matched to the city, from city_employers_count_db
+        'user_count', # skill user_count from skill1_db
+    )
+
     @classmethod
-    def process(self, api_client, max_api_calls, city_db, city_distances_db, skill1_db, skill2_db, result_db):
-        geonameid_to_name_map = self.load_custom_city_list_data(city_db)
-        calls = 0
+    def process(self, api_client, max_api_calls, city_db, city_distances_db, skill1_db, skill2_db, result_db, max_city_distance=None, concurrency=1, cache=None, resume=False, priority=None, city_employers_count_db=None, shard=None, neighbor_graph_db=None, store=None):
+        '''
+        With resume=True output rows already present in result_db are skipped (see skip_completed) and new rows are appended.
+        priority is a list of PRIORITIES names, queries are fetched in order of these values (largest first).
+        With shard=(i, N) only the i-th of N query shards (see get_shard) is processed, written to the
+        shard's own file (see get_shard_path); shard files are combined by merge_shards.
+        With store (locallib.OutputStore) cities and distances are read from the store (they must have been
+        written there after city_db and city_distances_db, see OutputStore.check_up_to_date) and the result is
+        also written to it (except for shards, merge_shards writes the merged result).
+        '''
+        metrics = locallib.metrics
+        if shard:
+            self.check_shard(shard)
+            result_db = self.get_shard_path(result_db, shard)
+        with metrics.phase('load') as phase:
+            if store:
+                store.check_up_to_date('cities', city_db)
+                store.check_up_to_date('city_distances', city_distances_db)
+            print 'CITIES AND DISTANCES READ FROM %s' % (store or '%s, %s' % (city_db, city_distances_db))
+            geonameid_to_name_map = self.load_custom_city_list_data(city_db, store)
+            completed = self.load_completed_rows(result_db) if resume else Counter()
+            phase['rows'] = len(geonameid_to_name_map)
+        if completed:
+            print 'RESUMING: %d output rows already done' % sum(completed.values())
+        with metrics.phase('plan') as phase:
+            plan = self.plan_queries(self.get_skill_and_city_combinations(city_distances_db, skill1_db, skill2_db, geonameid_to_name_map, max_city_distance, neighbor_graph_db, store))
+            if shard:
+                plan = [query for query in plan if self.get_shard(self.get_query_key(*query[:3]), shard[1]) == shard[0]]
+                print 'SHARD %d/%d: %d API queries' % (shard[0], shard[1], len(plan))
+            if priority:
+                plan = self.prioritize_queries(plan, priority, city_db, city_employers_count_db, skill1_db)
+            if completed:
+                plan = self.skip_completed(plan, completed)
+            phase['rows'] = len(plan)
+        combinations = ((city, skill, neighbor_cities) for city, skill, neighbor_cities, output_rows in plan)
+        # result rows are written as counts arrive, so this phase also includes writing the CSV
+        with metrics.phase('fetch') as phase:
+            phase['rows'] = 0
+            with open(result_db, 'ab' if resume else 'wb') as csvfile:
+                writer = csv.writer(csvfile)
+                for calls, ((_, _, _, output_rows), (city, skill, count)) in enumerate(izip(plan, self.fetch_counts(api_client, combinations, max_api_calls, concurrency, cache))):
+                    for skill, city in output_rows:
+                        data = (skill, city, count)
+                        writer.writerow(data)
+                    phase['rows'] += len(output_rows)
+                    # flush every 100 rows
+                    if calls % 100 == 0:
+                        csvfile.flush()
+                        os.fsync(csvfile.fileno())
+        if store and not shard:
+            with metrics.phase('write') as phase:
+                with open(result_db, 'rb') as csv_file:
+                    rows = [row for row in csv.reader(csv_file) if len(row) == 3]
+                store.write_city_skill_counts(rows)
+                phase['rows'] = len(rows)
+
+    @classmethod
+    def get_shard(self, query_key, shard_count):
+        '''
+        Shard (1..shard_count) of a query, stable across processes and hosts.
+        '''
+        return int(hashlib.md5(query_key.encode('utf8')).hexdigest(), 16) % shard_count + 1
+
+    @classmethod
+    def parse_shard(self, value):
+        '''
+        (i, N) shard of "i/N" command line value, 1 <= i <= N.
+        '''
+        try:
+            shard = tuple(int(i) for i in value.split('/'))
+        except (AttributeError, ValueError):
+            shard = ()
+        self.check_shard(shard, value)
+        return shard
+
+    @classmethod
+    def check_shard(self, shard, value=None):
+        '''
+        Raise unless shard is (i, N) with 1 <= i <= N, i.e. one of the shards get_shard assigns queries to.
+        '''
+        if len(shard) != 2 or not 1 <= shard[0] <= shard[1]:
+            raise Exception('Invalid shard "%s", use i/N with 1 <= i <= N (e.g. 1/4).' % (value or '/'.join('%s' % i for i in shard)))
+
+    @classmethod
+    def get_shard_path(self, result_db, shard):
+        return '%s.shard-%d-of-%d' % (result_db, shard[0], shard[1])
+
+    @classmethod
+    def merge_shards(self, city_db, city_distances_db, skill1_db, skill2_db, result_db, shard_count, max_city_distance=None, neighbor_graph_db=None, store=None):
+        '''
+        Combine shard files of shard_count shards into result_db, in query plan order. Output rows missing
+        from all shards or present more times than planned are reported and raise an exception after writing.
+        '''
+        if shard_count < 1:
+            raise Exception('Invalid shard count %d, must be at least 1.' % shard_count)
+        if store:
+            store.check_up_to_date('cities', city_db)
+            store.check_up_to_date('city_distances', city_distances_db)
+        geonameid_to_name_map = self.load_custom_city_list_data(city_db, store)
+        plan = self.plan_queries(self.get_skill_and_city_combinations(city_distances_db, skill1_db, skill2_db, geonameid_to_name_map, max_city_distance, neighbor_graph_db=neighbor_graph_db, store=store))
+        expected = Counter(output_row for _, _, _, output_rows in plan for output_row in output_rows)
+        counts = defaultdict(list)
+        for i in range(1, shard_count + 1):
+            path = self.get_shard_path(result_db, (i, shard_count))
+            if not os.path.exists(path):
+                print 'SHARD FILE MISSING: %s' % path
+                continue
+            with open(path, 'rb') as csv_file:
+                for row in csv.reader(csv_file):
+                    if len(row) == 3:
+                        counts[(row[0].decode('utf8'), row[1].decode('utf8'))].append(row[2])
+
+        duplicates = [key for key, values in counts.iteritems() if len(values) > expected[key]]
+        written = set()
+        missing = []
+        rows = []
+        for _, _, _, output_rows in plan:
+            for skill, city in output_rows:
+                if (skill, city) in written:
+                    continue
+                written.add((skill, city))
+                values = counts.get((skill, city), [])
+                if not values:
+                    missing.append((skill, city))
+                for count in values[:expected[(skill, city)]]:
+                    rows.append((skill, city, count))
         with open(result_db, 'wb') as csvfile:
-            writer = csv.writer(csvfile)
-            for city, skill, neighbor_cities in self.get_skill_and_city_combinations(city_distances_db, skill1_db, skill2_db, geonameid_to_name_map):
-                if calls >= max_api_calls:
-                    break
-                data = (skill, city, self.fetch_count_from_api(api_client, city, skill, neighbor_cities))
-                writer.writerow(data)
-                # flush every 100 rows
-                if calls % 100 == 0:
-                    csvfile.flush()
-                    os.fsync(csvfile.fileno())
-                calls += 1
+            csv.writer(csvfile).writerows(rows)
+        if store:
+            store.write_city_skill_counts(rows)
+
+        print 'MERGED: %d (skill, city) pairs, MISSING: %d, DUPLICATE: %d' % (len(written) - len(missing), len(missing), len(duplicates))
+        for skill, city in (missing + duplicates)[:10]:
+            print '  %s, %s: %s' % (skill, city, 'duplicate' if (skill, city) in counts else 'missing')
+        if missing or duplicates:
+            raise Exception('Shard files are incomplete or contain duplicates.')
+
+    @classmethod
+    def plan_queries(self, combinations):
+        '''
+        Group (city, skill, neighbor_cities) combinations by canonical query (see get_query_key), so every
+        distinct query is sent once. Returns [(city, skill, neighbor_cities, [(skill, city), ...]), ...]
+        in order of first occurrence, with all output rows answered by each query.
+        '''
+        queries = OrderedDict()
+        planned_count = 0
+        for city, skill, neighbor_cities in combinations:
+            planned_count += 1
+            key = self.get_query_key(city, skill, neighbor_cities)
+            if key not in queries:
+                queries[key] = (city, skill, neighbor_cities, [])
+            queries[key][3].append((skill, city))
+        print 'QUERY PLAN: %d output rows, %d unique API queries' % (planned_count, len(queries))
+        return queries.values()
+
+    @classmethod
+    def prioritize_queries(self, plan, priority, city_db, city_employers_count_db, skill1_db):
+        '''
+        Sort planned queries by priority values, largest first, so a run limited by max_api_calls
+        fetches the most valuable counts. Ties keep plan order.
+        '''
+        # functions of query (city, skill, neighbor_cities, output_rows) => value
+        value_getters = []
+        for name in priority:
+            if name == 'population':
+                population = self.load_city_population_data(city_db)
+                value_getters.append(lambda query, data=population: data.get(query[0], 0))
+            elif name == 'employers_count':
+                if not city_employers_count_db:
+                    raise Exception('Priority employers_count needs the city employers count DB written by create-city-db.py.')
+                employers_count = self.load_city_employers_count_data(city_employers_count_db, city_db)
+                value_getters.append(lambda query, data=employers_count: data.get(query[0], 0))
+            elif name == 'user_count':
+                user_count = self.load_skill_user_count_data(skill1_db)
+                value_getters.append(lambda query, data=user_count: data.get(query[1], 0))
+            else:
+                raise Exception('Unsupported priority "%s", use one of: %s.' % (name, ', '.join(self.PRIORITIES)))
+        return sorted(plan, key=lambda query: tuple(-get_value(query) for get_value in value_getters))
+
+    @classmethod
+    def skip_completed(self, plan, completed):
+        '''
+        Remove output rows already written by an interrupted run from plan, queries left without
+        output rows are dropped. completed is Counter of (skill, city) in result CSV (see load_completed_rows).
+
+        Rows are written in plan order, so the first completed[(skill, city)] output rows with that
+        (skill, city) are the written ones; cities of the same name (with different neighbors) are
+        told apart this way. The plan must be the same as in the interrupted run (same inputs and options).
+        '''
+        completed = Counter(completed)
+        remaining = []
+        for city, skill, neighbor_cities, output_rows in plan:
+            left = []
+            for output_row in output_rows:
+                if completed[output_row] > 0:
+                    completed[output_row] -= 1
+                else:
+                    left.append(output_row)
+            if left:
+                remaining.append((city, skill, neighbor_cities, left))
+        return remaining
+
+    @classmethod
+    def load_city_population_data(self, path):
+        '''
+        {city name: population, ...}, largest population for cities sharing a name.
+        '''
+        data = defaultdict(int)
+        with open(path , 'rb') as csv_file:
+            for row in CustomCityListImporter(csv_file):
+                data[row['name']] = max(data[row['name']], int(row['population'] or 0))
+        return data
+
+    @classmethod
+    def load_city_employers_count_data(self, path, city_db):
+        '''
+        {city name: employers_count, ...} from city employers count DB (by geonameid, see create-city-db.py),
+        largest employers_count for cities sharing a name.
+        '''
+        with open(path, 'rb') as csv_file:
+            employers_count = {row['geonameid']: int(row['employers_count'] or 0) for row in CityEmployersCountImporter(csv_file)}
+        data = defaultdict(int)
+        with open(city_db, 'rb') as csv_file:
+            for row in CustomCityListImporter(csv_file):
+                data[row['name']] = max(data[row['name']], employers_count.get(row['geonameid'], 0))
+        return data
+
+    @classmethod
+    def load_skill_user_count_data(self, path):
+        with open(path, 'rb') as csv_file:
+            return {unicode(row['name'], 'utf8'): int(row['user_count'] or 0) for row in CustomSkills1Importer(csv_file)}
+
+    @classmethod
+    def get_query_key(self, city, skill, neighbor_cities):
+        '''
+        Canonical query: skill and sorted set of locations (search results don't depend on location order).
+        '''
+        return json.dumps([skill, sorted(set([city] + list(neighbor_cities)))])
 
+    @classmethod
+    def fetch_counts(self, api_client, combinations, max_api_calls, concurrency=1, cache=None):
+        '''
+        Yield (city, skill, count) for (city, skill, neighbor_cities) combinations, in their original order,
+        with up to concurrency API requests in flight (each in its own thread).
 
+        Counts found in cache (ProviderCountCache) are not requested and don't count against max_api_calls;
+        fetched counts are stored in cache. Stops at the first combination needing a request over max_api_calls.
+        '''
+        tasks = Queue.Queue()
+        results = Queue.Queue()
+
+        def worker():
+            while True:
+                task = tasks.get()
+                if task is None:
+                    return
+                seq, (city, skill, neighbor_cities) = task
+                try:
+                    results.put((seq, (city, skill, self.fetch_count_from_api(api_client, city, skill, neighbor_cities)), None))
+                except Exception:
+                    results.put((seq, None, sys.exc_info()))
+
+        threads = [threading.Thread(target=worker) for _ in range(max(1, concurrency))]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+
+        combinations = iter(combinations)
+        # finished requests waiting for earlier ones, {seq: (result, exc_info)}
+        done = {}
+        # requests in flight, {seq: cache key}
+        cache_keys = {}
+        submitted = 0
+        next_seq = 0
+        calls = 0
+        cache_hits = 0
+        exhausted = False
+        try:
+            while True:
+                # results are yielded in order, so at most 2 * concurrency requests are submitted ahead
+                while not exhausted and submitted - next_seq < 2 * max(1, concurrency):
+                    try:
+                        city, skill, neighbor_cities = next(combinations)
+                    except StopIteration:
+                        exhausted = True
+                        break
+                    cache_key = self.get_query_key(city, skill, neighbor_cities) if cache else None
+                    count = cache.get(cache_key) if cache else None
+                    if count is not None:
+                        done[submitted] = ((city, skill, count), None)
+                        cache_hits += 1
+                        locallib.metrics.count('cache_hits')
+                    elif calls >= max_api_calls:
+                        exhausted = True
+                        break
+                    else:
+                        if cache:
+                            locallib.metrics.count('cache_misses')
+                        tasks.put((submitted, (city, skill, neighbor_cities)))
+                        if cache:
+                            cache_keys[submitted] = cache_key
+                        calls += 1
+                    submitted += 1
+                if next_seq == submitted:
+                    return
+                while next_seq not in done:
+                    seq, result, exc_info = results.get()
+                    done[seq] = (result, exc_info)
+                result, exc_info = done.pop(next_seq)
+                if exc_info:
+                    raise exc_info[0], exc_info[1], exc_info[2]
+                if next_seq in cache_keys:
+                    cache.put(cache_keys.pop(next_seq), result[2])
+                yield result
+                next_seq += 1
+        finally:
+            for _ in threads:
+                tasks.put(None)
+            if cache:
+                cache.commit()
+            print
+            print 'API CALLS: %d, CACHE HITS: %d' % (calls, cache_hits)
 
     @classmethod
     def fetch_count_from_api(self, api_client, city, skill, neighbor_cities):
@@ -90,28 +425,79 @@ class CityDataManager(object):
         }
         if DEBUG:
             print query_data['q'] 
-        return api_client.provider_v2.get('search/providers', data=query_data)['paging']['total']
+        count = api_client.provider_v2.get('search/providers', data=query_data)['paging']['total']
+        locallib.metrics.count('api_calls')
+        return count
 
     @classmethod
-    def get_skill_and_city_combinations(self, city_distances_db, skill1_db, skill2_db, geonameid_to_name_map):
-        for city, neighbor_cities in self.load_custom_city_distances_data(city_distances_db).iteritems():
-            for skill in self.load_custom_skill_data(skill1_db, skill2_db):
-                yield geonameid_to_name_map[city], skill, [geonameid_to_name_map[i] for i in neighbor_cities]
+    def get_skill_and_city_combinations(self, city_distances_db, skill1_db, skill2_db, geonameid_to_name_map, max_city_distance=None, neighbor_graph_db=None, store=None):
+        skills = self.load_custom_skill_data(skill1_db, skill2_db)
+        graph = self.load_custom_city_distances_data(city_distances_db, sorted(geonameid_to_name_map), max_city_distance, neighbor_graph_db, store)
+        names = [geonameid_to_name_map[geonameid] for geonameid in graph.geonameids]
+        for i, city in enumerate(names):
+            neighbor_indexes = graph.get_neighbor_indexes(i)
+            # only cities with neighbors are used
+            if not neighbor_indexes:
+                continue
+            neighbor_cities = [names[j] for j in neighbor_indexes]
+            for skill in skills:
+                yield city, skill, neighbor_cities
+
+    @classmethod
+    def load_completed_rows(self, path):
+        '''
+        Counter of (skill, city) rows already written to result CSV. A partially written last line (crash during write)
+        is cut off, so appended rows start on a new line.
+        '''
+        if not os.path.exists(path):
+            return Counter()
+        with open(path, 'rb+') as csv_file:
+            content = csv_file.read()
+            if content and not content.endswith('\n'):
+                csv_file.truncate(content.rfind('\n') + 1)
+                content = content[:content.rfind('\n') + 1]
+        return Counter((row[0].decode('utf8'), row[1].decode('utf8')) for row in csv.reader(content.splitlines()) if len(row) == 3)
 
 
     @classmethod
-    def load_custom_city_distances_data(self, path):
-        with open(path , 'rb') as csv_file:
-            reader = CustomCityDistancesImporter(csv_file)
-            data = [self.decode_row(row) for row in reader]
-            neighbor_cities = defaultdict(list)
-            for d in data:
-                neighbor_cities[d['geonameid1']].append(d['geonameid2'])
-                neighbor_cities[d['geonameid2']].append(d['geonameid1'])
-            return neighbor_cities
+    def load_custom_city_distances_data(self, path, geonameids, max_city_distance=None, graph_path=None, store=None):
+        '''
+        CityNeighborGraph of geonameids; with max_city_distance only pairs in radius bands up to
+        max_city_distance are used (distance DB must be generated with that band, see check_max_city_distance).
+
+        With graph_path the graph is memory-mapped from that file, which is (re)built when the distance DB,
+        geonameids or max_city_distance change.
+        '''
+        if max_city_distance is not None:
+            self.check_max_city_distance(path, max_city_distance)
+        if not graph_path:
+            return CityNeighborGraph.build(geonameids, path, max_city_distance, store)
+        path_stat = os.stat(path)
+        key = [os.path.abspath(path), path_stat.st_size, path_stat.st_mtime, max_city_distance, hashlib.md5('\n'.join(geonameids)).hexdigest()]
+        graph = CityNeighborGraph.load(graph_path)
+        if graph is None or graph.key != key:
+            CityNeighborGraph.build(geonameids, path, max_city_distance, store).save(graph_path, key)
+            graph = CityNeighborGraph.load(graph_path)
+        return graph
+
+    @classmethod
+    def check_max_city_distance(self, path, max_city_distance):
+        '''
+        Raise unless max_city_distance is one of the radius bands of the distance DB (from its manifest, see
+        create-city-distance-db.py): pairs are filtered by band, so other values would drop pairs of the next
+        band or, with a single band (distances without band column), let in pairs rounded down to it.
+        '''
+        distance_manager = imp.load_source('create_city_distance_db', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'create-city-distance-db.py')).CityDistanceManager
+        manifest = distance_manager.load_manifest(path)
+        if manifest is None:
+            raise Exception('Radius bands of %s are unknown (manifest %s is missing), regenerate it with create-city-distance-db.py.' % (path, distance_manager.get_manifest_path(path)))
+        if max_city_distance not in manifest[0]:
+            raise Exception('max_city_distance %g must be one of the radius bands of %s: %s.' % (max_city_distance, path, ', '.join('%g' % b for b in manifest[0])))
 
     @classmethod
-    def load_custom_city_list_data(self, path):
+    def load_custom_city_list_data(self, path, store=None):
+        if store:
+            return {i['geonameid']: i['name'] for i in store.get_cities()}
         with open(path , 'rb') as csv_file:
             reader = CustomCityListImporter(csv_file)
             return {i['geonameid']: i['name'] for i in reader}
@@ -138,9 +524,370 @@ class CityDataManager(object):
 
 
 
+class MappedIntArray(object):
+    '''
+    Read-only array of little-endian int32 values stored in buffer (e.g. mmap) from offset.
+    '''
+    def __init__(self, buffer, offset, length):
+        self.buffer = buffer
+        self.offset = offset
+        self.length = length
+
+    def __len__(self):
+        return self.length
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            start, stop, _ = key.indices(self.length)
+            return list(struct.unpack_from(str('<%di') % max(0, stop - start), self.buffer, self.offset + 4 * start))
+        return struct.unpack_from(str('<i'), self.buffer, self.offset + 4 * key)[0]
+
+
+
+class CityNeighborGraph(object):
+    '''
+    Compact (CSR) neighbor graph of the city distance data.
+
+    Cities are indexes into geonameids; neighbors of city i are neighbors[offsets[i]:offsets[i + 1]].
+    offsets and neighbors are int arrays, either in memory (array) or memory-mapped from a file
+    written by save (MappedIntArray), so several processes can share one copy.
+    '''
+    FILE_MAGIC = b'CSRGRAPH1\n'
+
+    def __init__(self, geonameids, offsets, neighbors, key=None):
+        self.geonameids = geonameids
+        self.offsets = offsets
+        self.neighbors = neighbors
+        self.key = key
+        self.positions = None
+
+    def get_neighbor_indexes(self, i):
+        return self.neighbors[self.offsets[i]:self.offsets[i + 1]]
+
+    def get_neighbors(self, geonameid):
+        if self.positions is None:
+            self.positions = {g: i for i, g in enumerate(self.geonameids)}
+        return [self.geonameids[j] for j in self.get_neighbor_indexes(self.positions[geonameid])]
+
+    @classmethod
+    def build(self, geonameids, city_distances_db, max_city_distance=None, store=None):
+        '''
+        Build graph streaming twice over the distance DB (or store, a locallib.OutputStore): count
+        neighbors of every city, then fill them in.
+        '''
+        positions = {g: i for i, g in enumerate(geonameids)}
+        offsets = array('i', [0]) * (len(geonameids) + 1)
+        for i, j in self.read_pairs(city_distances_db, positions, max_city_distance, store):
+            offsets[i + 1] += 1
+            offsets[j + 1] += 1
+        for i in xrange(len(geonameids)):
+            offsets[i + 1] += offsets[i]
+        neighbors = array('i', [0]) * offsets[-1]
+        fill = array('i', offsets)
+        for i, j in self.read_pairs(city_distances_db, positions, max_city_distance, store):
+            neighbors[fill[i]] = j
+            fill[i] += 1
+            neighbors[fill[j]] = i
+            fill[j] += 1
+        return self(geonameids, offsets, neighbors)
+
+    @classmethod
+    def read_pairs(self, city_distances_db, positions, max_city_distance=None, store=None):
+        if store:
+            for row in store.get_city_distances(max_city_distance):
+                yield positions[row[0]], positions[row[1]]
+            return
+        with open(city_distances_db, 'rb') as csv_file:
+            for row in CustomCityDistancesImporter(csv_file):
+                # band column is missing in distance DBs from before radius bands
+                if max_city_distance is not None and float(row['band'] or row['distance_in_miles']) > max_city_distance:
+                    continue
+                yield positions[row['geonameid1']], positions[row['geonameid2']]
+
+    def save(self, path, key):
+        '''
+        File layout: FILE_MAGIC, JSON header line (key, geonameids), offsets and neighbors as little-endian int32.
+        '''
+        header = json.dumps({'key': key, 'geonameids': self.geonameids})
+        offsets, neighbors = array('i', self.offsets), array('i', self.neighbors)
+        if sys.byteorder != 'little':
+            offsets.byteswap()
+            neighbors.byteswap()
+        with open(path + '.tmp', 'wb') as f:
+            f.write(self.FILE_MAGIC)
+            f.write(header + b'\n')
+            offsets.tofile(f)
+            neighbors.tofile(f)
+        os.rename(path + '.tmp', path)
+
+    @classmethod
+    def load(self, path):
+        '''
+        Memory-mapped graph saved by save, or None if there is no (valid) file.
+        '''
+        if not os.path.exists(path):
+            return None
+        with open(path, 'rb') as f:
+            if f.read(len(self.FILE_MAGIC)) != self.FILE_MAGIC:
+                return None
+            header = json.loads(f.readline())
+            offsets_start = f.tell()
+            buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        geonameids = [str(g) for g in header['geonameids']]
+        offsets = MappedIntArray(buffer, offsets_start, len(geonameids) + 1)
+        neighbors = MappedIntArray(buffer, offsets_start + 4 * len(offsets), offsets[len(geonameids)])
+        return self(geonameids, offsets, neighbors, header['key'])
+
+
+
+class ProviderCountCache(object):
+    '''
+    Persistent SQLite cache of provider search counts.
+
+    Keyed on the canonical query (CityDataManager.get_query_key). Entries older than ttl seconds are
+    ignored; over max_entries the oldest are evicted.
+    '''
+    EVICT_FRACTION = 0.1
+
+    def __init__(self, path, ttl=None, max_entries=None):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.connection = sqlite3.connect(path)
+        self.connection.execute('''
+            CREATE TABLE IF NOT EXISTS provider_count (
+                query TEXT PRIMARY KEY,
+                count INTEGER NOT NULL,
+                fetched_at REAL NOT NULL
+            )''')
+        self.connection.execute('CREATE INDEX IF NOT EXISTS provider_count_fetched_at ON provider_count (fetched_at)')
+        self.pending = 0
+        # number of entries, counted once here and kept up to date by put and commit
+        self.size = self.connection.execute('SELECT COUNT(*) FROM provider_count').fetchone()[0] if max_entries else None
+
+    def get(self, key):
+        row = self.connection.execute('SELECT count, fetched_at FROM provider_count WHERE query = ?', (key,)).fetchone()
+        if row is None or (self.ttl and row[1] < time.time() - self.ttl):
+            return None
+        return row[0]
+
+    def put(self, key, count):
+        fetched_at = time.time()
+        if not self.connection.execute('UPDATE provider_count SET count = ?, fetched_at = ? WHERE query = ?', (count, fetched_at, key)).rowcount:
+            self.connection.execute('INSERT INTO provider_count (query, count, fetched_at) VALUES (?, ?, ?)', (key, count, fetched_at))
+            if self.size is not None:
+                self.size += 1
+        self.pending += 1
+        if self.pending >= 100:
+            self.commit()
+
+    def commit(self):
+        if self.max_entries and self.size > self.max_entries:
+            evict = self.size - self.max_entries + int(self.max_entries * self.EVICT_FRACTION)
+            self.size -= self.connection.execute('DELETE FROM provider_count WHERE query IN (SELECT query FROM provider_count ORDER BY fetched_at LIMIT ?)', (evict,)).rowcount
+        self.connection.commit()
+        self.pending = 0
+
+
+
+class TokenBucket(object):
+    '''
+    Thread-safe token bucket: acquire() blocks until a token is available; tokens are added at rate
+    per second, up to burst.
+    '''
+    def __init__(self, rate, burst):
+        self.rate = float(rate)
+        self.burst = float(burst)
+        self.tokens = float(burst)
+        self.updated_at = time.time()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.time()
+                self.tokens = min(self.burst, self.tokens + (now - self.updated_at) * self.rate)
+                self.updated_at = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+
+class AdaptiveConcurrencyLimiter(object):
+    '''
+    Limits requests in flight, adjusting the limit AIMD style: +1 after limit successful requests
+    in a row (up to max_limit), halved when the API throttles.
+    '''
+    def __init__(self, max_limit, limit=1):
+        self.max_limit = max_limit
+        self.limit = min(limit, max_limit)
+        self.in_flight = 0
+        self.successes = 0
+        self.condition = threading.Condition()
+
+    def acquire(self):
+        with self.condition:
+            while self.in_flight >= self.limit:
+                self.condition.wait()
+            self.in_flight += 1
+
+    def release(self, throttled=False):
+        with self.condition:
+            self.in_flight -= 1
+            if throttled:
+                self.limit = max(1, self.limit // 2)
+                self.successes = 0
+            else:
+                self.successes += 1
+                if self.successes >= self.limit and self.limit < self.max_limit:
+                    self.limit += 1
+                    self.successes = 0
+            self.condition.notify_all()
+
+
+
+class RateLimitedApiClient(object):
+    '''
+    Wraps api_client.provider_v2.get with a TokenBucket, an AdaptiveConcurrencyLimiter and retries with
+    exponential backoff and full jitter on throttling (HTTP 429), server errors (HTTP 5xx) and network
+    errors. Other errors are raised immediately. On throttling the Retry-After header (seconds), if any,
+    is the minimum delay. Retries are extra requests, not counted against max_api_calls by fetch_counts.
+    '''
+    RETRY_HTTP_CODES = (429, 500, 502, 503, 504)
+
+    def __init__(self, api_client, token_bucket, max_concurrency, max_retries=5, base_delay=1.0, max_delay=60.0):
+        self.api_client = api_client
+        self.token_bucket = token_bucket
+        self.limiter = AdaptiveConcurrencyLimiter(max_concurrency)
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.provider_v2 = self
+
+    def get(self, url, data=None):
+        for attempt in range(self.max_retries + 1):
+            self.token_bucket.acquire()
+            self.limiter.acquire()
+            throttled = False
+            try:
+                return self.api_client.provider_v2.get(url, data=data)
+            except Exception as e:
+                throttled = self.is_retryable(e)
+                if not throttled or attempt == self.max_retries:
+                    raise
+                locallib.metrics.count('api_retries')
+                retry_after = self.get_retry_after(e)
+            finally:
+                self.limiter.release(throttled)
+            time.sleep(max(random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt)), retry_after or 0))
+
+    @classmethod
+    def is_retryable(self, error):
+        if getattr(error, 'code', None) in self.RETRY_HTTP_CODES:
+            return True
+        return isinstance(error, (socket.error, urllib2.URLError)) and not isinstance(error, urllib2.HTTPError)
+
+    def get_retry_after(self, error):
+        '''
+        Seconds of Retry-After header of throttled (HTTP 429) response, or None.
+        '''
+        headers = getattr(error, 'hdrs', None)
+        if getattr(error, 'code', None) != 429 or not headers:
+            return None
+        try:
+            return min(float(headers.get('Retry-After') or headers.get('retry-after')), self.max_delay)
+        except (TypeError, ValueError):
+            return None
+
+
+
+class TimedApiClient(object):
+    '''
+    Wraps api_client.provider_v2.get, recording the time of each request as 'api' latency metric.
+    Wrapped by RateLimitedApiClient, so rate limiting waits and retry backoff are not part of the latency.
+    '''
+    def __init__(self, api_client):
+        self.api_client = api_client
+        self.provider_v2 = self
+
+    def get(self, url, data=None):
+        start = time.time()
+        try:
+            return self.api_client.provider_v2.get(url, data=data)
+        finally:
+            locallib.metrics.record_latency('api', time.time() - start)
+
+
+
+class PooledApiClient(object):
+    '''
+    oDesk API client handing each thread its own odesk.Client (clients keep per-request state),
+    all sharing one keep-alive HTTP connection pool of pool_size connections.
+    With base_url (e.g. 'http://127.0.0.1:8765') API requests are sent there instead of to oDesk.
+    '''
+    def __init__(self, public_key, secret_key, access_token, access_token_secret, pool_size=1, base_url=None):
+        self.public_key = public_key
+        self.secret_key = secret_key
+        self.access_token = access_token
+        self.access_token_secret = access_token_secret
+        self.pool_size = pool_size
+        self.base_url = base_url
+        self.http = None
+        self.local = threading.local()
+        self.lock = threading.Lock()
+
+    def get_client(self):
+        client = getattr(self.local, 'client', None)
+        if client is None:
+            client = odesk.Client(self.public_key, self.secret_key,
+                                  oauth_access_token=self.access_token,
+                                  oauth_access_token_secret=self.access_token_secret)
+            with self.lock:
+                if self.http is None:
+                    # urllib3.PoolManager of the first client (keeps its certificate settings) is shared by all clients
+                    self.http = client.http
+                    self.http.connection_pool_kw[str('maxsize')] = self.pool_size
+            client.http = self.http
+            if self.base_url:
+                client.provider_v2.base_url = self.base_url.rstrip('/') + '/api/'
+            self.local.client = client
+        return client
+
+    @property
+    def auth(self):
+        return self.get_client().auth
+
+    @property
+    def provider_v2(self):
+        return self.get_client().provider_v2
+
+
+
 class ApiClientFactory(object):
     @classmethod
-    def get_odesk_client(self, public_key, secret_key):
+    def get_odesk_client(self, public_key, secret_key, token_cache_path=None, pool_size=1, base_url=None):
+        '''
+        PooledApiClient authorized with access token cached in token_cache_path when it is still valid,
+        otherwise with a new one obtained interactively (and cached).
+
+        With base_url the client targets a local stand-in API (benchmarks/fake_provider_api.py)
+        which doesn't check authorization, so no access token is needed.
+        '''
+        if base_url:
+            return PooledApiClient(public_key, secret_key, 'local', 'local', pool_size, base_url)
+        tokens = self.load_access_token(token_cache_path, public_key) if token_cache_path else None
+        if tokens:
+            client = PooledApiClient(public_key, secret_key, tokens[0], tokens[1], pool_size)
+            try:
+                client.auth.get_info()
+                return client
+            except urllib2.HTTPError as e:
+                if e.code not in (401, 403):
+                    raise
+                print 'Cached access token is no longer valid.'
+
         client = odesk.Client(public_key, secret_key)
         verifier = raw_input(
             'Please enter the verification code you get '
@@ -151,24 +898,102 @@ class ApiClientFactory(object):
         access_token, access_token_secret = client.auth.get_access_token(verifier)
         print 'OK'
 
-        # For further use you can store ``access_toket`` and
-        # ``access_token_secret`` somewhere
-        return odesk.Client(public_key, secret_key,
-                              oauth_access_token=access_token,
-                              oauth_access_token_secret=access_token_secret)
+        if token_cache_path:
+            self.save_access_token(token_cache_path, public_key, access_token, access_token_secret)
+        return PooledApiClient(public_key, secret_key, access_token, access_token_secret, pool_size)
 
+    @classmethod
+    def load_access_token(self, path, public_key):
+        '''
+        (access_token, access_token_secret) cached for public_key, or None.
+        '''
+        try:
+            with open(path, 'rb') as f:
+                data = json.load(f)
+        except (IOError, ValueError):
+            return None
+        if data.get('public_key') != public_key:
+            return None
+        return data['access_token'], data['access_token_secret']
 
-if __name__ == '__main__':
-    config = locallib.get_config()
-    print CityDataManager.process(
-        ApiClientFactory.get_odesk_client(config.get('odesk', 'public_key'), config.get('odesk', 'secret_key')),
+    @classmethod
+    def save_access_token(self, path, public_key, access_token, access_token_secret):
+        '''
+        Cache access token in a file readable only by the current user.
+        '''
+        fd = os.open(path + '.tmp', os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0600)
+        with os.fdopen(fd, 'wb') as f:
+            json.dump({
+                'public_key': public_key,
+                'access_token': access_token,
+                'access_token_secret': access_token_secret,
+                'created_at': time.time(),
+            }, f)
+        os.rename(path + '.tmp', path)
+
+
+def run(config, store=None):
+    '''
+    Process configured by config; store defaults to the configured OutputStore.
+    '''
+    api_client = TimedApiClient(ApiClientFactory.get_odesk_client(
+        config.get('odesk', 'public_key'),
+        config.get('odesk', 'secret_key'),
+        locallib.get_absolute_path(config.get('odesk', 'token_cache_path')) if config.has_option('odesk', 'token_cache_path') else None,
+        int(config.get('odesk', 'concurrency')) if config.has_option('odesk', 'concurrency') else 1,
+        config.get('odesk', 'api_base_url') if config.has_option('odesk', 'api_base_url') else None,
+    ))
+    if config.has_option('odesk', 'requests_per_second'):
+        api_client = RateLimitedApiClient(
+            api_client,
+            TokenBucket(float(config.get('odesk', 'requests_per_second')), float(config.get('odesk', 'burst'))),
+            int(config.get('odesk', 'concurrency')) if config.has_option('odesk', 'concurrency') else 1,
+            int(config.get('odesk', 'max_retries')),
+        )
+    CityDataManager.process(
+        api_client,
         int(config.get('odesk', 'max_api_calls')),
         locallib.get_absolute_path(config.get('output', 'target_city_db_path')),
         locallib.get_absolute_path(config.get('output','target_city_distances_db_path')),
         locallib.get_absolute_path(config.get('input','custom_skills1_db_path')),
         locallib.get_absolute_path(config.get('input','custom_skills2_db_path')),
         locallib.get_absolute_path(config.get('output','target_city_skill_contractor_count_db_path')),
+        float(config.get('skills', 'max_city_distance')) if config.has_option('skills', 'max_city_distance') and config.get('skills', 'max_city_distance') else None,
+        int(config.get('odesk', 'concurrency')) if config.has_option('odesk', 'concurrency') else 1,
+        ProviderCountCache(
+            locallib.get_absolute_path(config.get('cache', 'provider_count_cache_path')),
+            int(config.get('cache', 'provider_count_cache_ttl') or 0),
+            int(config.get('cache', 'provider_count_cache_max_entries') or 0),
+        ) if config.has_option('cache', 'provider_count_cache_path') else None,
+        '--resume' in sys.argv,
+        [p.strip() for p in config.get('skills', 'priority').split(',') if p.strip()] if config.has_option('skills', 'priority') else None,
+        locallib.get_absolute_path(config.get('output', 'target_city_employers_count_db_path')) if config.has_option('output', 'target_city_employers_count_db_path') else None,
+        CityDataManager.parse_shard(locallib.get_argument('--shard')) if '--shard' in sys.argv else None,
+        locallib.get_absolute_path(config.get('cache', 'city_neighbor_graph_path')) if config.has_option('cache', 'city_neighbor_graph_path') else None,
+        store or locallib.get_output_store(config),
     )
 
 
-
+if __name__ == '__main__':
+    config = locallib.get_config()
+    if '--merge' in sys.argv:
+        try:
+            CityDataManager.merge_shards(
+                locallib.get_absolute_path(config.get('output', 'target_city_db_path')),
+                locallib.get_absolute_path(config.get('output','target_city_distances_db_path')),
+                locallib.get_absolute_path(config.get('input','custom_skills1_db_path')),
+                locallib.get_absolute_path(config.get('input','custom_skills2_db_path')),
+                locallib.get_absolute_path(config.get('output','target_city_skill_contractor_count_db_path')),
+                int(locallib.get_argument('--merge')),
+                float(config.get('skills', 'max_city_distance')) if config.has_option('skills', 'max_city_distance') and config.get('skills', 'max_city_distance') else None,
+                locallib.get_absolute_path(config.get('cache', 'city_neighbor_graph_path')) if config.has_option('cache', 'city_neighbor_graph_path') else None,
+                locallib.get_output_store(config),
+            )
+        finally:
+            locallib.write_metrics_report(config, 'create-city-skills-users-db-merge')
+        sys.exit()
+    try:
+        run(config)
+    finally:
+        # also written when the run fails or is interrupted
+        locallib.write_metrics_report(config, 'create-city-skills-users-db')
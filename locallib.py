@@ -1,7 +1,15 @@
 # coding: utf-8
 from __future__ import unicode_literals
+import json
 import os
+import random
+import resource
+import sqlite3
+import sys
+import threading
+import time
 import ConfigParser
+from contextlib import contextmanager
 
 
 CONFIG_INI = os.path.dirname(os.path.abspath(__file__)) + '/config.ini'
@@ -17,3 +25,278 @@ def get_absolute_path(file_path):
     return os.path.dirname(os.path.abspath(__file__)) + '/' + file_path
 
 
+
+
+def get_argument(name, default=None):
+    '''
+    Value following command line option name (e.g. get_argument('--shard') for "--shard 1/4").
+    '''
+    if name not in sys.argv[:-1]:
+        return default
+    return sys.argv[sys.argv.index(name) + 1]
+
+
+class Metrics(object):
+    '''
+    Per run instrumentation: phase wall times and rows/sec, latency percentiles, counters and peak RSS.
+    Thread-safe; written as JSON by write_report.
+    '''
+    # latencies kept for percentiles per name (reservoir sample), count/total/max are exact
+    LATENCY_SAMPLE_SIZE = 100000
+
+    def __init__(self):
+        self.started_at = time.time()
+        self.phases = []
+        self.latencies = {}
+        self.counters = {}
+        self.lock = threading.Lock()
+
+    @contextmanager
+    def phase(self, name):
+        '''
+        Time block as phase name; set rows on the yielded dict to report rows/sec:
+
+            with metrics.phase('load') as phase:
+                phase['rows'] = len(data)
+        '''
+        phase = {'name': name, 'rows': None}
+        start = time.time()
+        try:
+            yield phase
+        finally:
+            phase['seconds'] = time.time() - start
+            if phase['rows'] is not None:
+                phase['rows_per_second'] = phase['rows'] / max(phase['seconds'], 1e-9)
+            with self.lock:
+                self.phases.append(phase)
+
+    def record_latency(self, name, seconds):
+        with self.lock:
+            latency = self.latencies.setdefault(name, {'count': 0, 'total': 0.0, 'max': 0.0, 'sample': []})
+            latency['count'] += 1
+            latency['total'] += seconds
+            latency['max'] = max(latency['max'], seconds)
+            if len(latency['sample']) < self.LATENCY_SAMPLE_SIZE:
+                latency['sample'].append(seconds)
+            else:
+                i = random.randint(0, latency['count'] - 1)
+                if i < self.LATENCY_SAMPLE_SIZE:
+                    latency['sample'][i] = seconds
+
+    def count(self, name, value=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def get_report(self):
+        with self.lock:
+            latencies = {}
+            for name, latency in self.latencies.iteritems():
+                sample = sorted(latency['sample'])
+                latencies[name] = {
+                    'count': latency['count'],
+                    'mean': latency['total'] / latency['count'],
+                    'p50': sample[int(0.50 * (len(sample) - 1))],
+                    'p90': sample[int(0.90 * (len(sample) - 1))],
+                    'p99': sample[int(0.99 * (len(sample) - 1))],
+                    'max': latency['max'],
+                }
+            counters = dict(self.counters)
+            if 'cache_hits' in counters or 'cache_misses' in counters:
+                lookups = counters.get('cache_hits', 0) + counters.get('cache_misses', 0)
+                counters['cache_hit_rate'] = float(counters.get('cache_hits', 0)) / lookups if lookups else None
+            return {
+                'started_at': self.started_at,
+                'seconds': time.time() - self.started_at,
+                # ru_maxrss is in kilobytes on Linux
+                'peak_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+                'peak_rss_children_kb': resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss,
+                'phases': list(self.phases),
+                'latencies': latencies,
+                'counters': counters,
+            }
+
+    def write_report(self, path):
+        with open(path, 'wb') as f:
+            json.dump(self.get_report(), f, indent=2, sort_keys=True)
+
+
+# instrumentation of the current run, shared by all modules
+metrics = Metrics()
+
+
+def write_metrics_report(config, script_name):
+    '''
+    Write metrics report of the current run to [metrics] report_dir as <script_name>-<time>.json, if configured.
+    '''
+    if not (config.has_option('metrics', 'report_dir') and config.get('metrics', 'report_dir')):
+        return
+    report_dir = get_absolute_path(config.get('metrics', 'report_dir'))
+    if not os.path.isdir(report_dir):
+        os.makedirs(report_dir)
+    path = os.path.join(report_dir, '%s-%s.json' % (script_name, time.strftime('%Y%m%d-%H%M%S')))
+    metrics.write_report(path)
+    print 'Metrics report written to %s' % path
+
+
+def get_output_store(config):
+    '''
+    OutputStore configured by [output] sqlite_db_path, or None.
+    '''
+    if not (config.has_option('output', 'sqlite_db_path') and config.get('output', 'sqlite_db_path')):
+        return None
+    return OutputStore(get_absolute_path(config.get('output', 'sqlite_db_path')))
+
+
+
+class OutputStore(object):
+    '''
+    Indexed SQLite store of the three script outputs (cities, city distances, skill/city contractor counts),
+    kept next to the CSV files. Tables are replaced in a single transaction with bulk inserts.
+    Values are stored as utf8 byte strings, as read from the CSV files.
+    '''
+    SCHEMA = '''
+        CREATE TABLE IF NOT EXISTS cities (
+            geonameid TEXT PRIMARY KEY,
+            name TEXT NOT NULL,
+            custom_region TEXT,
+            country_code TEXT,
+            population INTEGER,
+            longitude TEXT NOT NULL,
+            latitude TEXT NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS city_distances (
+            geonameid1 TEXT NOT NULL,
+            geonameid2 TEXT NOT NULL,
+            distance INTEGER NOT NULL,
+            band REAL
+        );
+        CREATE UNIQUE INDEX IF NOT EXISTS city_distances_geonameids ON city_distances (geonameid1, geonameid2);
+        CREATE INDEX IF NOT EXISTS city_distances_geonameid2 ON city_distances (geonameid2);
+        CREATE TABLE IF NOT EXISTS city_skill_counts (
+            skill TEXT NOT NULL,
+            city TEXT NOT NULL,
+            count INTEGER NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS city_skill_counts_skill_city ON city_skill_counts (skill, city);
+        CREATE TABLE IF NOT EXISTS table_writes (
+            name TEXT PRIMARY KEY,
+            rows INTEGER NOT NULL,
+            written_at REAL NOT NULL
+        );
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        self.connection = sqlite3.connect(path)
+        self.connection.text_factory = str
+        self.connection.executescript(self.SCHEMA)
+
+    def __str__(self):
+        return self.path
+
+    def check_up_to_date(self, table, csv_path):
+        '''
+        Raise if table was never written by a stage or csv_path (the stage's CSV output) was written
+        after it, i.e. the store holds no or stale data (e.g. the stage was run without sqlite_db_path).
+        '''
+        row = self.connection.execute('SELECT written_at FROM table_writes WHERE name = ?', (table,)).fetchone()
+        if row is None:
+            raise Exception('Table %s of %s was never written, rerun the stage writing %s with this sqlite_db_path or unset sqlite_db_path.' % (table, self.path, csv_path))
+        if os.path.exists(csv_path) and os.path.getmtime(csv_path) > row[0]:
+            raise Exception('%s is newer than table %s of %s, rerun the stage writing it with this sqlite_db_path or unset sqlite_db_path.' % (csv_path, table, self.path))
+
+    def replace_rows(self, table, columns, rows):
+        '''
+        Replace all rows of table, recording the write in table_writes (see check_up_to_date).
+        '''
+        with self.connection:
+            self.connection.execute('DELETE FROM %s' % table)
+            cursor = self.connection.executemany(
+                'INSERT INTO %s (%s) VALUES (%s)' % (table, ', '.join(columns), ', '.join('?' * len(columns))),
+                ([self.encode(v) for v in row] for row in rows),
+            )
+            self.connection.execute('INSERT OR REPLACE INTO table_writes (name, rows, written_at) VALUES (?, ?, ?)', (table, cursor.rowcount, time.time()))
+
+    @classmethod
+    def encode(self, value):
+        return value.encode('utf8') if isinstance(value, unicode) else value
+
+    def write_cities(self, rows):
+        self.replace_rows('cities', ['geonameid', 'name', 'custom_region', 'country_code', 'population', 'longitude', 'latitude'], rows)
+
+    def write_city_distances(self, rows):
+        '''
+        rows are [geonameid1, geonameid2, distance] or [geonameid1, geonameid2, distance, band]
+        '''
+        self.replace_rows('city_distances', ['geonameid1', 'geonameid2', 'distance', 'band'], (list(row) + [None] * (4 - len(row)) for row in rows))
+
+    def write_city_skill_counts(self, rows):
+        self.replace_rows('city_skill_counts', ['skill', 'city', 'count'], rows)
+
+    def get_cities(self):
+        '''
+        [{geonameid, name, custom_region, country_code, population, longitude, latitude}, ...] in written order.
+        '''
+        cursor = self.connection.execute('SELECT geonameid, name, custom_region, country_code, population, longitude, latitude FROM cities ORDER BY rowid')
+        columns = [c[0] for c in cursor.description]
+        return [dict(zip(columns, row)) for row in cursor]
+
+    def get_city_distances(self, max_band=None):
+        '''
+        Iterate (geonameid1, geonameid2, distance, band) in written order, only with band <= max_band if given.
+        '''
+        if max_band is None:
+            return self.connection.execute('SELECT geonameid1, geonameid2, distance, band FROM city_distances ORDER BY rowid')
+        return self.connection.execute('SELECT geonameid1, geonameid2, distance, band FROM city_distances WHERE COALESCE(band, distance) <= ? ORDER BY rowid', (max_band,))
+
+    def get_neighbors(self, geonameid):
+        return [row[0] for row in self.connection.execute(
+            'SELECT geonameid2 FROM city_distances WHERE geonameid1 = ? UNION ALL SELECT geonameid1 FROM city_distances WHERE geonameid2 = ?', (geonameid, geonameid))]
+
+    def get_city_skill_count(self, skill, city):
+        row = self.connection.execute('SELECT count FROM city_skill_counts WHERE skill = ? AND city = ?', (self.encode(skill), self.encode(city))).fetchone()
+        return row[0] if row else None
+
+
+class MemoryStore(object):
+    '''
+    In-memory stand-in for OutputStore used to hand stage outputs directly to the next stage
+    (see run-pipeline.py). Writes are also passed to store (an OutputStore), if given.
+    '''
+    CITY_COLUMNS = ['geonameid', 'name', 'custom_region', 'country_code', 'population', 'longitude', 'latitude']
+
+    def __init__(self, store=None):
+        self.store = store
+        self.cities = []
+        self.city_distances = []
+        self.city_skill_counts = []
+
+    def __str__(self):
+        return 'memory'
+
+    def check_up_to_date(self, table, csv_path):
+        # outputs are written by this process (or loaded from the CSV files), never stale
+        pass
+
+    def write_cities(self, rows):
+        self.cities = [[OutputStore.encode(v) for v in row] for row in rows]
+        if self.store:
+            self.store.write_cities(self.cities)
+
+    def write_city_distances(self, rows):
+        self.city_distances = [list(row) + [None] * (4 - len(row)) for row in rows]
+        if self.store:
+            self.store.write_city_distances(self.city_distances)
+
+    def write_city_skill_counts(self, rows):
+        self.city_skill_counts = list(rows)
+        if self.store:
+            self.store.write_city_skill_counts(self.city_skill_counts)
+
+    def get_cities(self):
+        return [dict(zip(self.CITY_COLUMNS, row)) for row in self.cities]
+
+    def get_city_distances(self, max_band=None):
+        if max_band is None:
+            return iter(self.city_distances)
+        return (row for row in self.city_distances if float(row[3] or row[2]) <= max_band)
@@ -0,0 +1,205 @@
+# coding: utf-8
+from __future__ import unicode_literals
+import csv
+import hashlib
+import imp
+import json
+import os
+import sys
+import locallib
+
+ROOT_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+class PipelineStage(object):
+    '''
+    Stage of the pipeline: script run with run(config, store), stages it depends on, input files and
+    config options it reads ((section, option), input files are given as config options too, unset ones
+    are ignored) and its output file.
+    '''
+    def __init__(self, name, script, depends, input_options, config_options, output_option, load_output):
+        self.name = name
+        self.script = script
+        self.depends = depends
+        self.input_options = input_options
+        self.config_options = config_options
+        self.output_option = output_option
+        # fills MemoryStore with the stage output read from its CSV file, used when the stage is skipped
+        self.load_output = load_output
+
+    def get_module(self):
+        return imp.load_source(self.script.replace('-', '_'), os.path.join(ROOT_DIR, self.script + '.py'))
+
+    def get_output_path(self, config):
+        return locallib.get_absolute_path(config.get(*self.output_option))
+
+
+class PipelineManager(object):
+    '''
+    Runs create-city-db -> create-city-distance-db -> create-city-skills-users-db in one process, stage outputs
+    are handed to the next stage in a locallib.MemoryStore (CSV files are still written).
+
+    A stage is skipped when its fingerprint (script, input files and config options, see get_fingerprint) is the
+    same as on its last successful run, recorded in the state file, and its output file is still the one that
+    run wrote (same md5, e.g. not rewritten by running the script alone with other options).
+    '''
+    STAGES = [
+        PipelineStage(
+            'cities',
+            'create-city-db',
+            [],
+            [
+                ('input', 'custom_city_db_path'),
+                ('input', 'official_city_db_path'),
+                ('input', 'admin1_codes_db_path'),
+                ('input', 'country_info_db_path'),
+            ],
+            [('output', 'target_city_db_path'), ('output', 'target_city_employers_count_db_path')],
+            ('output', 'target_city_db_path'),
+            lambda store, path: store.write_cities(PipelineManager.read_csv(path)),
+        ),
+        PipelineStage(
+            'distances',
+            'create-city-distance-db',
+            ['cities'],
+            [('output', 'target_city_db_path')],
+            [('output', 'target_city_distances_db_path'), ('distance', 'radius_bands')],
+            ('output', 'target_city_distances_db_path'),
+            lambda store, path: store.write_city_distances(PipelineManager.read_csv(path)),
+        ),
+        PipelineStage(
+            'skills',
+            'create-city-skills-users-db',
+            ['cities', 'distances'],
+            [
+                ('output', 'target_city_db_path'),
+                ('output', 'target_city_distances_db_path'),
+                ('input', 'custom_skills1_db_path'),
+                ('input', 'custom_skills2_db_path'),
+                ('output', 'target_city_employers_count_db_path'),
+            ],
+            [
+                ('output', 'target_city_skill_contractor_count_db_path'),
+                ('odesk', 'max_api_calls'),
+                ('odesk', 'api_base_url'),
+                ('skills', 'max_city_distance'),
+                ('skills', 'priority'),
+            ],
+            ('output', 'target_city_skill_contractor_count_db_path'),
+            lambda store, path: store.write_city_skill_counts(PipelineManager.read_csv(path)),
+        ),
+    ]
+    # options changing the output of every stage
+    COMMON_CONFIG_OPTIONS = [('output', 'sqlite_db_path')]
+
+    @classmethod
+    def process(self, config, state_path, force=False):
+        store = locallib.MemoryStore(locallib.get_output_store(config))
+        state = self.load_state(state_path)
+        # stages whose output is in store
+        loaded = set()
+        for stage in self.get_ordered_stages():
+            fingerprint = self.get_fingerprint(config, stage)
+            output_path = stage.get_output_path(config)
+            last_run = state.get(stage.name)
+            if not force and isinstance(last_run, dict) and last_run['fingerprint'] == fingerprint and last_run['output'] == self.get_file_digest(output_path):
+                print 'STAGE %s: UNCHANGED, SKIPPED' % stage.name
+                continue
+            for depend in stage.depends:
+                if depend not in loaded:
+                    print 'STAGE %s: LOADING OUTPUT OF %s' % (stage.name, depend)
+                    self.get_stage(depend).load_output(store, self.get_stage(depend).get_output_path(config))
+                    loaded.add(depend)
+            print 'STAGE %s: RUNNING' % stage.name
+            with locallib.metrics.phase('stage %s' % stage.name):
+                stage.get_module().run(config, store)
+            loaded.add(stage.name)
+            state[stage.name] = {'fingerprint': fingerprint, 'output': self.get_file_digest(output_path)}
+            self.save_state(state_path, state)
+
+    @classmethod
+    def get_ordered_stages(self):
+        '''
+        STAGES in dependency order.
+        '''
+        ordered = []
+        names = set()
+        pending = list(self.STAGES)
+        while pending:
+            ready = [stage for stage in pending if set(stage.depends) <= names]
+            if not ready:
+                raise Exception('Circular stage dependencies: %s' % ', '.join(stage.name for stage in pending))
+            for stage in ready:
+                ordered.append(stage)
+                names.add(stage.name)
+                pending.remove(stage)
+        return ordered
+
+    @classmethod
+    def get_stage(self, name):
+        return [stage for stage in self.STAGES if stage.name == name][0]
+
+    @classmethod
+    def get_fingerprint(self, config, stage):
+        '''
+        md5 of the stage script and input file contents and of the config option values.
+        '''
+        fingerprint = hashlib.md5()
+        paths = [os.path.join(ROOT_DIR, stage.script + '.py'), os.path.join(ROOT_DIR, 'locallib.py')]
+        paths += [locallib.get_absolute_path(config.get(*option)) for option in stage.input_options if config.has_option(*option)]
+        for path in paths:
+            fingerprint.update(path.encode('utf8') + b'\0')
+            self.update_digest(fingerprint, path)
+        for section, option in stage.config_options + self.COMMON_CONFIG_OPTIONS:
+            value = config.get(section, option) if config.has_option(section, option) else None
+            fingerprint.update(json.dumps([section, option, value]).encode('utf8'))
+        return fingerprint.hexdigest()
+
+    @classmethod
+    def update_digest(self, digest, path):
+        if os.path.exists(path):
+            with open(path, 'rb') as f:
+                for chunk in iter(lambda: f.read(1 << 20), b''):
+                    digest.update(chunk)
+
+    @classmethod
+    def get_file_digest(self, path):
+        '''
+        md5 of the file contents, or None if it doesn't exist.
+        '''
+        if not os.path.exists(path):
+            return None
+        digest = hashlib.md5()
+        self.update_digest(digest, path)
+        return digest.hexdigest()
+
+    @classmethod
+    def read_csv(self, path):
+        with open(path, 'rb') as csv_file:
+            return [row for row in csv.reader(csv_file) if row]
+
+    @classmethod
+    def load_state(self, path):
+        try:
+            with open(path, 'rb') as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return {}
+
+    @classmethod
+    def save_state(self, path, state):
+        with open(path + '.tmp', 'wb') as f:
+            json.dump(state, f, indent=2, sort_keys=True)
+        os.rename(path + '.tmp', path)
+
+
+if __name__ == '__main__':
+    config = locallib.get_config()
+    try:
+        PipelineManager.process(
+            config,
+            locallib.get_absolute_path(config.get('pipeline', 'state_path')) if config.has_option('pipeline', 'state_path') else locallib.get_absolute_path('data/.pipeline_state.json'),
+            '--force' in sys.argv,
+        )
+    finally:
+        locallib.write_metrics_report(config, 'run-pipeline')